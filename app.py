@@ -5,12 +5,14 @@ import traceback
 import hashlib
 import hmac
 
-from flask import Flask, request, jsonify, render_template, redirect, url_for, flash
+from flask import Flask, request, jsonify, render_template, redirect, url_for, flash, Response
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user
 
 from automod.automod import Goku
+from automod.backfill import Trunks
 from instancedb.instancedb import Piccolo
-from app_utils import ComponentManager, Logging, SettingsManager
+from app_utils import ComponentManager, Logging, SettingsManager, Metrics, Profiler
+from app_state import create_state_backend
 
 from mastodon import Mastodon
 
@@ -19,10 +21,14 @@ CONFIG_FILE = "global_config.json"
 
 # Initialize the application component manager
 component_manager = ComponentManager()
-component_manager.register_component("logging", Logging())
 component_manager.register_component("settings", SettingsManager(CONFIG_FILE, component_manager))
+component_manager.register_component("state", create_state_backend(component_manager.get_component("settings").get_config("base")))
+component_manager.register_component("logging", Logging(state = component_manager.get_component("state")))
+component_manager.register_component("metrics", Metrics())
+component_manager.register_component("profiler", Profiler(component_manager))
 component_manager.register_component("piccolo", Piccolo(component_manager))
 component_manager.register_component("goku", Goku(component_manager), True)
+component_manager.register_component("trunks", Trunks(component_manager), True)
 
 # Load base config data
 if component_manager.get_component("settings").get_config("base")["i_promise_to_be_really_careful"] == False:
@@ -33,6 +39,9 @@ SECRET_KEY = component_manager.get_component("settings").get_config("base")["app
 CONNECTED_INSTANCE = component_manager.get_component("settings").get_config("base")["connected_instance"]
 CLIENT_CRED_FILE = component_manager.get_component("settings").get_config("base")["client_cred_file"] 
 
+# Pick up edits to the config file and db_raw without a restart
+component_manager.get_component("settings").start_watching(component_manager.get_component("settings").get_config("base").get("config_watch_interval", 5.0))
+
 # Set up flask
 app = Flask(__name__)
 app.secret_key = SECRET_KEY + f"{os.urandom(32)}"
@@ -167,8 +176,50 @@ def get_state(component):
         return jsonify({"error": f"No such component: {component}"}), 404
     return render_component(component)
 
+@app.route("/profile/start/<component>", methods=["POST"])
+@login_required
+def start_profiling(component):
+    """
+    Start sampling a running component for some number of cycles
+    """
+    if not component_manager.is_bg_processing_component(component):
+        return jsonify({"error": f"No such component: {component}"}), 404
+    if component_manager.get_component(component).state() != "running":
+        return jsonify({"error": f"Component not running: {component}"}), 409
+    cycles = int(request.values.get("cycles", 5))
+    component_manager.get_component("profiler").start(component, cycles)
+    return render_component(component)
+
+@app.route("/profile/stop/<component>", methods=["POST"])
+@login_required
+def stop_profiling(component):
+    """
+    Stop sampling early
+    """
+    if not component_manager.is_bg_processing_component(component):
+        return jsonify({"error": f"No such component: {component}"}), 404
+    component_manager.get_component("profiler").stop(component)
+    return render_component(component)
+
+@app.route("/profile/<component>/<kind>", methods=["GET"])
+@login_required
+def get_profile(component, kind):
+    """
+    Download the last profile for a component, either as collapsed stacks (flamegraph input) or as torch op table
+    """
+    session = component_manager.get_component("profiler").get_session(component)
+    if session is None:
+        return jsonify({"error": f"No profile for component: {component}"}), 404
+    if kind == "stacks":
+        data = session.collapsed_stacks()
+    elif kind == "torch":
+        data = session.torch_op_table()
+    else:
+        return jsonify({"error": f"No such profile type: {kind}"}), 404
+    return Response(data, mimetype="text/plain", headers={"Content-Disposition": f"attachment; filename={component}_{kind}.txt"})
+
 def render_component(component):
-    return render_template('component.html', component_name=component, component=component_manager.get_component(component))
+    return render_template('component.html', component_name=component, component=component_manager.get_component(component), profile=component_manager.get_component("profiler").get_session(component))
 
 @app.route('/logs', methods=['GET'])
 @login_required
@@ -182,6 +233,23 @@ def get_logs():
     else:
         return jsonify({"error": "No logging component found"}), 404
 
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """
+    Prometheus scrape target. Only counts and timings, so no login (scrapers can't do oauth)
+    """
+    metrics = component_manager.get_component("metrics")
+    return Response(metrics.render_prometheus(), mimetype="text/plain; version=0.0.4")
+
+@app.route('/metrics_summary', methods=['GET'])
+@login_required
+def get_metrics_summary():
+    """
+    Returns metrics summary for the dashboard
+    """
+    metrics = component_manager.get_component("metrics")
+    return render_template('metrics.html', metrics=metrics.summary())
+
 @app.route('/settings', methods=['GET'])
 @login_required
 def get_settings():
@@ -250,6 +318,19 @@ def instance_info():
     else: 
         return render_template('instance_search.html')
 
+def verify_webhook_signature():
+    """
+    Check the X-Hub-Signature header against the configured webhook secret
+    """
+    signature_header = request.headers.get('X-Hub-Signature')
+    if signature_header is None:
+        return False
+    _, signature = signature_header.split('=')
+    webhook_secret = component_manager.get_component("settings").get_config("goku")["webhook_secret"].encode("utf8")
+    hashed = hmac.new(webhook_secret, request.get_data(), hashlib.sha256)
+    digest = hashed.hexdigest()
+    return hmac.compare_digest(digest, signature)
+
 @app.route('/invoke_goku_status', methods=['GET', 'POST'])
 def invoke_goku_status():
     """
@@ -262,15 +343,7 @@ def invoke_goku_status():
         piccolo = component_manager.get_component("piccolo")
         if settings_manager is not None and goku is not None and not piccolo is None:
             # Verify signature
-            signature_header = request.headers.get('X-Hub-Signature')
-            if signature_header is None:
-                return jsonify({"error": "Invalid secret"}), 403
-            
-            _, signature = signature_header.split('=')
-            webhook_secret = settings_manager.get_config("goku")["webhook_secret"].encode("utf8")
-            hashed = hmac.new(webhook_secret, request.get_data(), hashlib.sha256)
-            digest = hashed.hexdigest()
-            if not hmac.compare_digest(digest, signature):
+            if not verify_webhook_signature():
                 return jsonify({"error": "Invalid secret"}), 403
 
             # Parse request
@@ -298,6 +371,31 @@ def invoke_goku_status():
         component_manager.get_component("logging").add_log("Goku", "Error", f"Error in status check webhook: {exc_str}")
     return jsonify({"error": "Internal error"}), 500    
 
+@app.route('/invoke_goku_account', methods=['POST'])
+def invoke_goku_account():
+    """
+    Queue a new account for checking (webhook target for account.created / account.approved)
+    """
+    try:
+        if not component_manager.have_component("goku"):
+            return jsonify({"error": "Not ready"}), 404
+        if not verify_webhook_signature():
+            return jsonify({"error": "Invalid secret"}), 403
+
+        post_dict = request.json
+        if not post_dict.get("event") in ("account.created", "account.approved"):
+            return jsonify({"status": "ignored"})
+        account_id = post_dict["object"]["id"]
+        if isinstance(account_id, str) and account_id.isdigit():
+            account_id = int(account_id)
+        if not component_manager.get_component("goku").enqueue_account(account_id):
+            return jsonify({"error": "Queue full"}), 503
+        return jsonify({"status": "queued"})
+    except Exception:
+        exc_str = traceback.format_exc()
+        component_manager.get_component("logging").add_log("Goku", "Error", f"Error in account webhook: {exc_str}")
+    return jsonify({"error": "Internal error"}), 500
+
 @app.route('/autocomplete_instance')
 @login_required
 def autocomplete_instance():
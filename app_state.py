@@ -0,0 +1,256 @@
+# Shared state for components, so several app replicas can work off the same sets, caches and logs
+
+import os
+import time
+import pickle
+import socket
+import sqlite3
+import threading
+
+class StateBackend:
+    """
+    Interface for state that has to be shared between replicas:
+     * named sets of ids, with an atomic claim (add if not present) so only one replica acts on an id
+     * a key value cache, split into namespaces
+     * a log
+     * expiring leases, for leader election
+
+    Set members and keys are stored as strings.
+    """
+    persistent = False
+
+    def set_add(self, name, member):
+        raise NotImplementedError()
+
+    def set_remove(self, name, member):
+        raise NotImplementedError()
+
+    def set_contains(self, name, member):
+        raise NotImplementedError()
+
+    def set_size(self, name):
+        raise NotImplementedError()
+
+    def set_members(self, name):
+        raise NotImplementedError()
+
+    def claim(self, name, member):
+        """
+        Add member to the set, returns True if this call added it and False if it was there already
+        """
+        raise NotImplementedError()
+
+    def kv_get(self, namespace, key, default = None):
+        raise NotImplementedError()
+
+    def kv_set(self, namespace, key, value):
+        raise NotImplementedError()
+
+    def kv_keys(self, namespace):
+        raise NotImplementedError()
+
+    def kv_size(self, namespace):
+        raise NotImplementedError()
+
+    def append_log(self, timestamp, component, severity, message, max_logs):
+        raise NotImplementedError()
+
+    def get_logs(self, n):
+        """
+        Most recent n logs (oldest first) as (timestamp, component, severity, message) tuples
+        """
+        raise NotImplementedError()
+
+    def acquire_lease(self, name, holder, duration):
+        """
+        Take or renew the named lease for duration seconds. Returns True if holder has the lease now.
+        """
+        raise NotImplementedError()
+
+    def release_lease(self, name, holder):
+        raise NotImplementedError()
+
+class MemoryStateBackend(StateBackend):
+    """
+    Process local state, for running a single replica (and the default)
+    """
+    def __init__(self):
+        self.sets = {}
+        self.kv = {}
+        self.logs = []
+        self.leases = {}
+        self.lock = threading.Lock()
+
+    def set_add(self, name, member):
+        with self.lock:
+            self.sets.setdefault(name, set()).add(str(member))
+
+    def set_remove(self, name, member):
+        with self.lock:
+            self.sets.get(name, set()).discard(str(member))
+
+    def set_contains(self, name, member):
+        return str(member) in self.sets.get(name, set())
+
+    def set_size(self, name):
+        return len(self.sets.get(name, set()))
+
+    def set_members(self, name):
+        with self.lock:
+            return set(self.sets.get(name, set()))
+
+    def claim(self, name, member):
+        with self.lock:
+            members = self.sets.setdefault(name, set())
+            if str(member) in members:
+                return False
+            members.add(str(member))
+            return True
+
+    def kv_get(self, namespace, key, default = None):
+        return self.kv.get(namespace, {}).get(str(key), default)
+
+    def kv_set(self, namespace, key, value):
+        with self.lock:
+            self.kv.setdefault(namespace, {})[str(key)] = value
+
+    def kv_keys(self, namespace):
+        return list(self.kv.get(namespace, {}).keys())
+
+    def kv_size(self, namespace):
+        return len(self.kv.get(namespace, {}))
+
+    def append_log(self, timestamp, component, severity, message, max_logs):
+        with self.lock:
+            self.logs.append((timestamp, component, severity, message))
+            if len(self.logs) > max_logs:
+                self.logs = self.logs[-max_logs:]
+
+    def get_logs(self, n):
+        return self.logs[-n:]
+
+    def acquire_lease(self, name, holder, duration):
+        with self.lock:
+            current_holder, expires = self.leases.get(name, (None, 0.0))
+            if current_holder != holder and expires > time.time():
+                return False
+            self.leases[name] = (holder, time.time() + duration)
+            return True
+
+    def release_lease(self, name, holder):
+        with self.lock:
+            if self.leases.get(name, (None, 0.0))[0] == holder:
+                del self.leases[name]
+
+class SqliteStateBackend(StateBackend):
+    """
+    State in a SQLite database, shared by all processes that open the same file.
+    Good for several replicas on one machine (or tests); SQLite over network filesystems is not reliable,
+    so replicas on multiple nodes need a backend on a proper database server.
+    """
+    persistent = True
+
+    def __init__(self, path, timeout = 30.0):
+        self.path = path
+        self.timeout = timeout
+        self.local = threading.local()
+        connection = self.connection()
+        connection.execute("PRAGMA journal_mode=WAL")
+        with connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS sets (name TEXT NOT NULL, member TEXT NOT NULL, PRIMARY KEY (name, member))")
+            connection.execute("CREATE TABLE IF NOT EXISTS kv (namespace TEXT NOT NULL, key TEXT NOT NULL, value BLOB, PRIMARY KEY (namespace, key))")
+            connection.execute("CREATE TABLE IF NOT EXISTS logs (id INTEGER PRIMARY KEY AUTOINCREMENT, timestamp REAL, component TEXT, severity TEXT, message TEXT)")
+            connection.execute("CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, holder TEXT NOT NULL, expires REAL NOT NULL)")
+
+    def connection(self):
+        """
+        One connection per thread, sqlite connections can't be shared
+        """
+        if getattr(self.local, "connection", None) is None:
+            self.local.connection = sqlite3.connect(self.path, timeout = self.timeout, isolation_level = None)
+            self.local.connection.execute("PRAGMA synchronous=NORMAL")
+        return self.local.connection
+
+    def set_add(self, name, member):
+        self.connection().execute("INSERT OR IGNORE INTO sets (name, member) VALUES (?, ?)", (name, str(member)))
+
+    def set_remove(self, name, member):
+        self.connection().execute("DELETE FROM sets WHERE name = ? AND member = ?", (name, str(member)))
+
+    def set_contains(self, name, member):
+        return self.connection().execute("SELECT 1 FROM sets WHERE name = ? AND member = ?", (name, str(member))).fetchone() is not None
+
+    def set_size(self, name):
+        return self.connection().execute("SELECT COUNT(*) FROM sets WHERE name = ?", (name,)).fetchone()[0]
+
+    def set_members(self, name):
+        return set(x[0] for x in self.connection().execute("SELECT member FROM sets WHERE name = ?", (name,)))
+
+    def claim(self, name, member):
+        return self.connection().execute("INSERT OR IGNORE INTO sets (name, member) VALUES (?, ?)", (name, str(member))).rowcount == 1
+
+    def kv_get(self, namespace, key, default = None):
+        row = self.connection().execute("SELECT value FROM kv WHERE namespace = ? AND key = ?", (namespace, str(key))).fetchone()
+        if row is None:
+            return default
+        return pickle.loads(row[0])
+
+    def kv_set(self, namespace, key, value):
+        self.connection().execute("INSERT OR REPLACE INTO kv (namespace, key, value) VALUES (?, ?, ?)", (namespace, str(key), pickle.dumps(value, protocol = pickle.HIGHEST_PROTOCOL)))
+
+    def kv_keys(self, namespace):
+        return [x[0] for x in self.connection().execute("SELECT key FROM kv WHERE namespace = ?", (namespace,))]
+
+    def kv_size(self, namespace):
+        return self.connection().execute("SELECT COUNT(*) FROM kv WHERE namespace = ?", (namespace,)).fetchone()[0]
+
+    def append_log(self, timestamp, component, severity, message, max_logs):
+        connection = self.connection()
+        log_id = connection.execute("INSERT INTO logs (timestamp, component, severity, message) VALUES (?, ?, ?, ?)", (timestamp, component, severity, message)).lastrowid
+        # Trim in steps rather than on every insert
+        if log_id % 100 == 0:
+            connection.execute("DELETE FROM logs WHERE id <= ?", (log_id - max_logs,))
+
+    def get_logs(self, n):
+        rows = self.connection().execute("SELECT timestamp, component, severity, message FROM logs ORDER BY id DESC LIMIT ?", (n,)).fetchall()
+        return rows[::-1]
+
+    def acquire_lease(self, name, holder, duration):
+        connection = self.connection()
+        now = time.time()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = connection.execute("SELECT holder, expires FROM leases WHERE name = ?", (name,)).fetchone()
+            if row is not None and row[0] != holder and row[1] > now:
+                acquired = False
+            else:
+                connection.execute("INSERT OR REPLACE INTO leases (name, holder, expires) VALUES (?, ?, ?)", (name, holder, now + duration))
+                acquired = True
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+        return acquired
+
+    def release_lease(self, name, holder):
+        self.connection().execute("DELETE FROM leases WHERE name = ? AND holder = ?", (name, holder))
+
+def create_state_backend(base_config):
+    """
+    State backend as configured in the base config ("state_backend": "memory" or "sqlite", "state_db_file")
+    """
+    backend = base_config.get("state_backend", "memory")
+    if backend == "memory":
+        return MemoryStateBackend()
+    if backend == "sqlite":
+        return SqliteStateBackend(base_config["state_db_file"])
+    raise ValueError(f"Unknown state backend: {backend}")
+
+def get_replica_id(base_config):
+    """
+    Name of this replica for leases, configured or host + pid
+    """
+    replica_id = base_config.get("replica_id", "")
+    if replica_id == "":
+        replica_id = f"{socket.gethostname()}-{os.getpid()}"
+    return replica_id
@@ -1,5 +1,14 @@
+import os
+import sys
+import copy
 import time
 import json
+import bisect
+import threading
+import traceback
+from types import MappingProxyType
+from collections import Counter
+from contextlib import contextmanager
 from shutil import move
 
 class LogEntry:
@@ -16,16 +25,20 @@ class Logging:
     """
     Basig log message storage
     """
-    def __init__(self, max_logs=2000, severities = ["Debug", "Info", "Warn", "Error", "Fatal"]):
+    def __init__(self, max_logs=2000, severities = ["Debug", "Info", "Warn", "Error", "Fatal"], state = None):
         self.logs = []
         self.max_logs = max_logs
         self.severities = severities
+        self.state = state # shared state backend, if logs should be shared between replicas
 
     def add_log(self, component, severity, message):
-        timestamp = time.time()
-        log_entry = LogEntry(timestamp, component, severity, message)
         if not severity in self.severities:
             return
+        timestamp = time.time()
+        if self.state is not None:
+            self.state.append_log(timestamp, component, severity, message, self.max_logs)
+            return
+        log_entry = LogEntry(timestamp, component, severity, message)
         
         self.logs.append(log_entry)
 
@@ -33,39 +46,181 @@ class Logging:
             self.logs = self.logs[-self.max_logs:]
 
     def get_log(self, n=None):
+        if self.state is not None:
+            return [LogEntry(*x) for x in self.state.get_logs(self.max_logs if n is None else n)]
         if n is None:
             return self.logs
         else:
             return self.logs[-n:]
 
+def path_fingerprint(path):
+    """
+    Cheap change detection for a file or directory tree: hash of names, sizes and modification times
+    """
+    if not os.path.exists(path):
+        return None
+    if not os.path.isdir(path):
+        stat = os.stat(path)
+        return hash((stat.st_mtime_ns, stat.st_size))
+    entries = []
+    pending = [path]
+    while len(pending) > 0:
+        with os.scandir(pending.pop()) as scan:
+            for entry in scan:
+                if entry.is_dir():
+                    pending.append(entry.path)
+                else:
+                    stat = entry.stat()
+                    entries.append((entry.path, stat.st_mtime_ns, stat.st_size))
+    return hash(tuple(sorted(entries)))
+
+class ConfigSnapshot:
+    """
+    Read-only view of the config as of one version. Never changes, a config change publishes a new snapshot.
+    path_versions has a counter for every watched path, which goes up when something in that path changes.
+    """
+    def __init__(self, version, config, path_versions):
+        self.version = version
+        self.config = MappingProxyType({x: MappingProxyType(copy.deepcopy(config[x])) for x in config})
+        self.path_versions = MappingProxyType(dict(path_versions))
+
+    def get_config(self, component = None):
+        if component is None:
+            # Return config but without "base" component
+            return {x: self.config[x] for x in self.config if x != "base"}
+        else:
+            return self.config[component]
+
 class SettingsManager:
     """
-    Another mostly-a-dict-wrapper but it loads and stores from/to a json file
+    Another mostly-a-dict-wrapper but it loads and stores from/to a json file.
+
+    Readers get versioned, immutable snapshots, and can subscribe to be told about new ones. Changes come
+    from set_config_value, edits to the config file, or changes in watched paths (see watch_config_path),
+    picked up by poll_changes (which the watcher thread runs periodically, if started).
     """
     def __init__(self, config_path, component_manager):
         self.path = config_path
         self.temp_path = config_path + ".tmp"
         self.config = json.load(open(self.path, 'rb'))
+        self.config_fingerprint = path_fingerprint(self.path)
         self.component_manager = component_manager
+        self.watched_paths = {}
+        self.path_fingerprints = {}
+        self.path_versions = {}
+        self.subscribers = []
+        self.lock = threading.RLock()
+        self.version = 0
+        self.snapshot = ConfigSnapshot(self.version, self.config, self.path_versions)
+        self._watcher_thread = None
+        self._watcher_stop = threading.Event()
     
     def get_config(self, component = None):
-        if component is None:
-            # Return config but without "base" component
-            return {x: self.config[x] for x in self.config if x != "base"}
-        else:
-            return self.config[component]
+        return self.snapshot.get_config(component)
+
+    def get_snapshot(self):
+        return self.snapshot
+
+    def subscribe(self, callback):
+        """
+        Call callback(snapshot) whenever a new config version is published
+        """
+        self.subscribers.append(callback)
+
+    def publish(self):
+        with self.lock:
+            self.version += 1
+            self.snapshot = ConfigSnapshot(self.version, self.config, self.path_versions)
+            snapshot = self.snapshot
+        for callback in list(self.subscribers):
+            try:
+                callback(snapshot)
+            except Exception:
+                exc_str = traceback.format_exc()
+                self.component_manager.get_component("logging").add_log("settings", "Error", f"Error in config change callback: {exc_str}")
 
     def set_config_value(self, component, key, value):
         # There's a potential data race here if two people try to edit the config at the same time, but that largely just woN't matter
         dirty = False
-        if self.config[component][key] != value:
-            self.component_manager.get_component("logging").add_log("settings", "warn", f"changing setting {key} from {self.config[component][key]} to {value}.")
-            self.config[component][key] = value
-            dirty = True
+        with self.lock:
+            if self.config[component][key] != value:
+                self.component_manager.get_component("logging").add_log("settings", "warn", f"changing setting {key} from {self.config[component][key]} to {value}.")
+                self.config = copy.deepcopy(self.config)
+                self.config[component][key] = value
+                dirty = True
+            if dirty:
+                # Atomic-write config
+                json.dump(self.config, open(self.temp_path, 'w'))
+                move(self.temp_path, self.path)
+                self.config_fingerprint = path_fingerprint(self.path)
         if dirty:
-            # Atomic-write config
-            json.dump(self.config, open(self.temp_path, 'w'))
-            move(self.temp_path, self.path)
+            self.publish()
+
+    def watch_config_path(self, name, component, key):
+        """
+        Watch the file or directory that config value component/key points to (resolved on every check,
+        so changing the setting moves the watch along)
+        """
+        with self.lock:
+            if name in self.watched_paths:
+                return
+            self.watched_paths[name] = (component, key)
+            self.path_fingerprints[name] = path_fingerprint(self.config[component][key])
+            self.path_versions[name] = 0
+        self.publish()
+
+    def poll_changes(self):
+        """
+        Check the config file and watched paths once, publishing a new version if anything changed.
+        Returns True if it did.
+        """
+        changed = False
+        with self.lock:
+            config_fingerprint = path_fingerprint(self.path)
+            if config_fingerprint != self.config_fingerprint:
+                self.config_fingerprint = config_fingerprint
+                try:
+                    self.config = json.load(open(self.path, 'rb'))
+                    changed = True
+                    self.component_manager.get_component("logging").add_log("settings", "Info", f"Reloaded {self.path}")
+                except Exception as e:
+                    # Probably caught mid-edit, keep the old config
+                    self.component_manager.get_component("logging").add_log("settings", "Error", f"Could not reload {self.path}: {e}")
+            for name, (component, key) in self.watched_paths.items():
+                fingerprint = path_fingerprint(self.config[component][key])
+                if fingerprint != self.path_fingerprints[name]:
+                    self.path_fingerprints[name] = fingerprint
+                    self.path_versions[name] += 1
+                    changed = True
+        if changed:
+            self.publish()
+        return changed
+
+    def is_watching(self):
+        return self._watcher_thread is not None and self._watcher_thread.is_alive()
+
+    def start_watching(self, interval = 5.0):
+        """
+        Poll for changes in a background thread
+        """
+        if self.is_watching():
+            return
+        self._watcher_stop.clear()
+        self._watcher_thread = threading.Thread(target=self.watch_loop, args=(interval,), daemon=True)
+        self._watcher_thread.start()
+
+    def stop_watching(self):
+        self._watcher_stop.set()
+        if self._watcher_thread:
+            self._watcher_thread.join()
+
+    def watch_loop(self, interval):
+        while not self._watcher_stop.wait(interval):
+            try:
+                self.poll_changes()
+            except Exception:
+                exc_str = traceback.format_exc()
+                self.component_manager.get_component("logging").add_log("settings", "Error", f"Error in config watcher: {exc_str}")
 
 class ComponentManager:
     """
@@ -90,4 +245,265 @@ class ComponentManager:
         return compoent_name in self.components_with_bg_processing
 
     def get_components_with_bg_processing(self):
-        return{x: self.components[x] for x in list(self.components_with_bg_processing)}
\ No newline at end of file
+        return{x: self.components[x] for x in list(self.components_with_bg_processing)}
+
+class Metrics:
+    """
+    Counters, gauges and latency histograms, rendered as prometheus text.
+    Gauges that are expensive to compute can be registered as callbacks, which only run when someone reads them.
+    """
+    def __init__(self, buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)):
+        self.buckets = tuple(buckets)
+        self.counters = {}
+        self.gauges = {}
+        self.gauge_callbacks = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def reset(self):
+        """
+        Drop all recorded values (registered gauge callbacks stay)
+        """
+        with self.lock:
+            self.counters = {}
+            self.gauges = {}
+            self.histograms = {}
+
+    @staticmethod
+    def _key(name, labels):
+        return (name, tuple(sorted(labels.items())))
+
+    def inc(self, name, value = 1, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set_gauge(self, name, value, **labels):
+        self.gauges[self._key(name, labels)] = value
+
+    def register_gauge(self, name, callback, **labels):
+        self.gauge_callbacks[self._key(name, labels)] = callback
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        bucket_idx = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            if not key in self.histograms:
+                self.histograms[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            histogram = self.histograms[key]
+            histogram[0][bucket_idx] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def _read_gauges(self):
+        gauges = dict(self.gauges)
+        for key, callback in list(self.gauge_callbacks.items()):
+            try:
+                gauges[key] = callback()
+            except Exception:
+                pass
+        return gauges
+
+    @staticmethod
+    def _format_labels(labels, extra = ()):
+        labels = tuple(labels) + tuple(extra)
+        if len(labels) == 0:
+            return ""
+        return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+    def _estimate_quantile(self, bucket_counts, count, quantile):
+        """
+        Linear interpolation within the histogram bucket the quantile falls into
+        """
+        if count == 0:
+            return 0.0
+        rank = quantile * count
+        seen = 0
+        lower = 0.0
+        for idx, bucket_count in enumerate(bucket_counts):
+            upper = self.buckets[idx] if idx < len(self.buckets) else self.buckets[-1]
+            if seen + bucket_count >= rank and bucket_count > 0:
+                return lower + (upper - lower) * (rank - seen) / bucket_count
+            seen += bucket_count
+            lower = upper
+        return self.buckets[-1]
+
+    def render_prometheus(self):
+        """
+        Everything, in prometheus text exposition format
+        """
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {k: (list(v[0]), v[1], v[2]) for k, v in self.histograms.items()}
+        gauges = self._read_gauges()
+
+        lines = []
+        def add_series(series, metric_type, render):
+            seen_names = set()
+            for (name, labels), value in sorted(series.items(), key=lambda x: (x[0][0], str(x[0][1]))):
+                if not name in seen_names:
+                    lines.append(f"# TYPE {name} {metric_type}")
+                    seen_names.add(name)
+                render(name, labels, value)
+
+        add_series(counters, "counter", lambda name, labels, value: lines.append(f"{name}{self._format_labels(labels)} {value}"))
+        add_series(gauges, "gauge", lambda name, labels, value: lines.append(f"{name}{self._format_labels(labels)} {value}"))
+        def render_histogram(name, labels, value):
+            bucket_counts, total, count = value
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                cumulative += bucket_count
+                lines.append(f"{name}_bucket{self._format_labels(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{name}_bucket{self._format_labels(labels, [('le', '+Inf')])} {count}")
+            lines.append(f"{name}_sum{self._format_labels(labels)} {total}")
+            lines.append(f"{name}_count{self._format_labels(labels)} {count}")
+        add_series(histograms, "histogram", render_histogram)
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """
+        Compact view for the dashboard: histograms with mean and estimated p50/p99 (in ms), counters and gauges
+        """
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {k: (list(v[0]), v[1], v[2]) for k, v in self.histograms.items()}
+        gauges = self._read_gauges()
+
+        def display_name(name, labels):
+            return name + self._format_labels(labels)
+
+        timings = []
+        for (name, labels), (bucket_counts, total, count) in sorted(histograms.items()):
+            timings.append({
+                "name": display_name(name, labels),
+                "count": count,
+                "mean_ms": total / count * 1000.0 if count > 0 else 0.0,
+                "p50_ms": self._estimate_quantile(bucket_counts, count, 0.5) * 1000.0,
+                "p99_ms": self._estimate_quantile(bucket_counts, count, 0.99) * 1000.0,
+            })
+        return {
+            "timings": timings,
+            "counters": {display_name(name, labels): value for (name, labels), value in sorted(counters.items())},
+            "gauges": {display_name(name, labels): value for (name, labels), value in sorted(gauges.items(), key=lambda x: (x[0][0], str(x[0][1])))},
+        }
+
+class ProfileSession:
+    """
+    One sampling run against a components worker thread
+    """
+    def __init__(self, component_name, component, cycles, interval):
+        self.component_name = component_name
+        self.component = component
+        self.cycles = cycles
+        self.interval = interval
+        self.start_cycle = getattr(component, "cycle_count", None)
+        self.started_at = time.time()
+        self.stopped_at = None
+        self.samples = 0
+        self.stacks = Counter()
+        self.torch_ops = {}
+        self.torch_lock = threading.Lock()
+        self._stop_request = threading.Event()
+        self._thread = threading.Thread(target=self.sample_loop, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop_request.set()
+        if self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def is_running(self):
+        return self.stopped_at is None
+
+    def cycles_done(self):
+        if self.start_cycle is None:
+            return None
+        return self.component.cycle_count - self.start_cycle
+
+    def sample_loop(self):
+        """
+        Grab the worker threads stack every interval until stopped or enough cycles have passed
+        """
+        while not self._stop_request.is_set():
+            worker_thread = getattr(self.component, "_worker_thread", None)
+            frame = None
+            if worker_thread is not None and worker_thread.ident is not None:
+                frame = sys._current_frames().get(worker_thread.ident)
+            if frame is not None:
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({code.co_filename.split('/')[-1]}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                self.stacks[";".join(reversed(stack))] += 1
+                self.samples += 1
+            cycles_done = self.cycles_done()
+            if cycles_done is not None and cycles_done >= self.cycles:
+                break
+            time.sleep(self.interval)
+        self.stopped_at = time.time()
+
+    def add_torch_profile(self, torch_profile):
+        """
+        Fold the op level averages of one torch.profiler run into the session totals
+        """
+        with self.torch_lock:
+            for event in torch_profile.key_averages():
+                op = self.torch_ops.setdefault(event.key, [0, 0.0, 0.0])
+                op[0] += event.count
+                op[1] += event.self_cpu_time_total
+                op[2] += event.cpu_time_total
+
+    def collapsed_stacks(self):
+        """
+        Collapsed stack format, as eaten by flamegraph.pl / speedscope / inferno
+        """
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+    def torch_op_table(self):
+        with self.torch_lock:
+            ops = sorted(self.torch_ops.items(), key=lambda x: x[1][1], reverse=True)
+        lines = [f"{'op':<48} {'calls':>8} {'self cpu (ms)':>14} {'total cpu (ms)':>15}"]
+        for name, (count, self_cpu_us, cpu_us) in ops:
+            lines.append(f"{name[:48]:<48} {count:>8} {self_cpu_us / 1000.0:>14.2f} {cpu_us / 1000.0:>15.2f}")
+        return "\n".join(lines) + "\n"
+
+class Profiler:
+    """
+    On-demand sampling profiler for background processing components. Keeps the last session per component
+    around so results can be downloaded after it stops.
+    """
+    def __init__(self, component_manager, interval = 0.01):
+        self.component_manager = component_manager
+        self.interval = interval
+        self.sessions = {}
+
+    def start(self, component_name, cycles = 5):
+        if self.is_profiling(component_name):
+            return self.sessions[component_name]
+        self.component_manager.get_component("logging").add_log("Profiler", "Info", f"Profiling {component_name} for {cycles} cycles")
+        session = ProfileSession(component_name, self.component_manager.get_component(component_name), cycles, self.interval)
+        self.sessions[component_name] = session
+        session.start()
+        return session
+
+    def stop(self, component_name):
+        if component_name in self.sessions:
+            self.sessions[component_name].stop()
+            self.component_manager.get_component("logging").add_log("Profiler", "Info", f"Stopped profiling {component_name}")
+
+    def is_profiling(self, component_name):
+        return component_name in self.sessions and self.sessions[component_name].is_running()
+
+    def get_session(self, component_name):
+        return self.sessions.get(component_name)
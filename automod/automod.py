@@ -6,7 +6,6 @@ import open_clip
 from glob import glob
 import json
 from pathlib import Path
-import copy
 from collections import defaultdict, OrderedDict
 import requests
 import io
@@ -18,13 +17,22 @@ from mastodon import Mastodon
 import numpy as np
 import threading
 import traceback
+import queue
 import re
+from contextlib import contextmanager
+
+from app_state import get_replica_id
+from automod.wave_clustering import WaveClusterer
+from automod.domain_waves import DomainWaveAggregator
+from automod.score_recording import ScoreRecorder
 
 @dataclass
 class Report:
     data: dict
     reason: str
     likelihood: float
+    members: list = field(default_factory=list) # other accounts covered by a consolidated (wave) report
+    clusters: list = field(default_factory=list) # (WaveClusterer, cluster index) pairs of the wave, for wave reports
 
 """
 First, some utilities that I didn't feel like bothering putting into the class
@@ -62,6 +70,31 @@ def get_image_embed(image, image_preprocessor, clip_model):
         image_embed = image_embed[0].cpu().numpy()
     return image_embed
 
+def get_text_embeds(texts, tokenizer, clip_model):
+    with torch.no_grad():
+        texts = tokenizer(texts)
+        text_embeds = clip_model.encode_text(texts)
+        text_embeds /= text_embeds.norm(dim=-1, keepdim=True)
+        text_embeds = text_embeds.cpu().numpy()
+    return text_embeds
+
+def get_image_embeds(images, image_preprocessor, clip_model):
+    with torch.no_grad():
+        images = torch.stack([image_preprocessor(image) for image in images])
+        image_embeds = clip_model.encode_image(images)
+        image_embeds /= image_embeds.norm(dim=-1, keepdim=True)
+        image_embeds = image_embeds.cpu().numpy()
+    return image_embeds
+
+def load_models():
+    clip_model, _, image_preprocessor = open_clip.create_model_and_transforms('ViT-B-32', pretrained='laion2b_s34b_b79k')
+    text_tokenizer = open_clip.get_tokenizer('ViT-B-32')
+    return {
+        "clip_model": clip_model,
+        "text_tokenizer": text_tokenizer,
+        "image_preprocessor": image_preprocessor,
+    }
+
 # IO helpers
 def read_image(path):
     return Image.open(path).convert("RGBA").convert("RGB")
@@ -92,6 +125,31 @@ class Goku:
         self._is_running = threading.Event()
         self._stop_request = threading.Event()
         self._worker_thread = None
+        self.cycle_count = 0
+        self.panic_count = 0
+        self.busy = threading.Event() # set while checking accounts, so background jobs can stay out of the way
+        self.score_recorder = None
+
+        # Account ids pushed in from webhooks / event sources, drained by the worker thread
+        self.account_queue = queue.Queue(maxsize = 10000)
+        self.accounts_since_poll = 0
+
+        # With several replicas, only the one holding the lease polls for new accounts
+        self.replica_id = get_replica_id(self.component_manager.get_component("settings").get_config("base"))
+        self.is_leader = False
+        self.lease_renewed = 0.0
+
+        # Rolling per-domain hit counts, for collapsing instance-wide waves into one report
+        self.domain_waves = DomainWaveAggregator(self.component_manager.get_component("settings").get_config("goku").get("domain_wave_window", 3600))
+        self.limited_domains = set()
+
+        # Trigger db only gets rebuilt when its inputs change
+        self.db_dirty = threading.Event()
+        self.db_dirty.set()
+        self.db_config_key = None
+        self.component_manager.get_component("settings").watch_config_path("goku_raw_db", "goku", "raw_db_dir")
+        self.component_manager.get_component("settings").subscribe(self.on_config_change)
+        self.on_config_change(self.component_manager.get_component("settings").get_snapshot())
 
         # Empty trigger database for initial state
         self.trigger_db = {
@@ -99,9 +157,7 @@ class Goku:
             "pre_matrices": { },
             "config": None,
             "last_checked_user_id": 0,
-            "field_history": defaultdict(list),
-            "reported_ids": set( ),
-            "reported_ids_nosuspend": set( ),
+            "clusters": { },
             "seen_ids": list( )
         }
 
@@ -109,15 +165,27 @@ class Goku:
         if os.path.exists(self.component_manager.get_component("settings").get_config("goku")["embed_db_file"]):
             with open(self.component_manager.get_component("settings").get_config("goku")["embed_db_file"], 'rb') as f:
                 self.trigger_db.update(pickle.load(f))
+        self.trigger_db.pop("field_history", None)
+        for clusterer in self.trigger_db["clusters"].values(): # clusters from older caches have no report ids yet
+            if not hasattr(clusterer, "report_ids"):
+                clusterer.report_ids = [None] * len(clusterer.members)
+
+        # Reported ids are shared between replicas via the state backend, move over any from older caches
+        for reported_set in ["reported_ids", "reported_ids_nosuspend"]:
+            for account_id in self.trigger_db.pop(reported_set, set()):
+                self.component_manager.get_component("state").set_add("goku_" + reported_set, account_id)
 
         # Load models
-        clip_model, _, image_preprocessor = open_clip.create_model_and_transforms('ViT-B-32', pretrained='laion2b_s34b_b79k')
-        text_tokenizer = open_clip.get_tokenizer('ViT-B-32')
-        self.models = {
-            "clip_model": clip_model,
-            "text_tokenizer": text_tokenizer,
-            "image_preprocessor": image_preprocessor,
-        }
+        self.models = load_models()
+
+        # Sizes are read lazily, only when metrics are scraped
+        self.component_manager.get_component("metrics").register_gauge("goku_seen_ids", lambda: len(self.trigger_db["seen_ids"]))
+        self.component_manager.get_component("metrics").register_gauge("goku_reported_ids", lambda: self.component_manager.get_component("state").set_size("goku_reported_ids"))
+        self.component_manager.get_component("metrics").register_gauge("goku_reported_ids_nosuspend", lambda: self.component_manager.get_component("state").set_size("goku_reported_ids_nosuspend"))
+        self.component_manager.get_component("metrics").register_gauge("goku_is_leader", lambda: int(self.is_leader))
+        self.component_manager.get_component("metrics").register_gauge("goku_domain_wave_domains", lambda: len(self.domain_waves))
+        self.component_manager.get_component("metrics").register_gauge("goku_wave_clusters", lambda: sum(len(x) for x in self.trigger_db["clusters"].values()))
+        self.component_manager.get_component("metrics").register_gauge("goku_account_queue_depth", lambda: self.account_queue.qsize())
 
     def start(self):
         """
@@ -145,42 +213,200 @@ class Goku:
             return "running"
         return "stopped"
 
+    @contextmanager
+    def clip_profile(self):
+        """
+        Collect torch op timings for CLIP calls while someone is profiling this component. Only on the worker
+        thread: torch profilers can't nest, and webhook or trunks calls would mix into the session otherwise.
+        """
+        if threading.current_thread() is not self._worker_thread:
+            yield
+            return
+        if not self.component_manager.have_component("profiler") or not self.component_manager.get_component("profiler").is_profiling("goku"):
+            yield
+            return
+        with torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU]) as torch_profile:
+            yield
+        self.component_manager.get_component("profiler").get_session("goku").add_torch_profile(torch_profile)
+
+    def embed_image(self, image):
+        with self.component_manager.get_component("metrics").timer("goku_stage_seconds", stage="clip_encode_image"):
+            with self.clip_profile():
+                return get_image_embed(image, self.models["image_preprocessor"], self.models["clip_model"])
+
+    def embed_text(self, text):
+        with self.component_manager.get_component("metrics").timer("goku_stage_seconds", stage="clip_encode_text"):
+            with self.clip_profile():
+                return get_text_embed(text, self.models["text_tokenizer"], self.models["clip_model"])
+
+    def embed_images(self, images):
+        """
+        Batched version of embed_image, returns a (len(images), dim) matrix
+        """
+        with self.component_manager.get_component("metrics").timer("goku_stage_seconds", stage="clip_encode_image_batch"):
+            with self.clip_profile():
+                return get_image_embeds(images, self.models["image_preprocessor"], self.models["clip_model"])
+
+    def embed_texts(self, texts):
+        """
+        Batched version of embed_text, returns a (len(texts), dim) matrix
+        """
+        with self.component_manager.get_component("metrics").timer("goku_stage_seconds", stage="clip_encode_text_batch"):
+            with self.clip_profile():
+                return get_text_embeds(texts, self.models["text_tokenizer"], self.models["clip_model"])
+
+    def get_field_value(self, field_raw, user_dict, posts_dicts):
+        """
+        Find the value to check for a field, or None if there is nothing (usable) to check
+        """
+        field_type = field_raw.split(".")[0]
+        field = ".".join(field_raw.split(".")[1:])
+        if field_type == "account":
+            check_dict = user_dict
+        elif field_type == "status":
+            check_dict = posts_dicts
+        else:
+            assert False, "Invalid field type: " + str(field_type)
+
+        # Find field value
+        self.component_manager.get_component("logging").add_log("Goku", "Trace", f"Checking field {field}")
+        field_val = get_by_path(check_dict, field)
+        if field_val is None:
+            return None
+        self.component_manager.get_component("logging").add_log("Goku", "Trace", f"Value is {field_val}")
+
+        # Check against ignore list so we don't report for missing ava/header, or being the internal fetch actor
+        if field_val in self.trigger_db["config"]["fields"][field_raw]["ignore"]:
+            return None
+
+        # Bail if below minimum length
+        min_len = 1
+        if self.trigger_db["config"]["fields"][field_raw]["type"] == "text":
+            # Strip html (or rather: anything between <.*>)
+            field_val = re.sub(r'<.*?>', '', field_val)
+            min_len = self.trigger_db["config"]["fields"][field_raw]["min_len"]
+        if len(field_val) < min_len:
+            return None
+        return field_val
+
+    def match_report(self, user_dict, matches, best_match_likelihood, config = None):
+        """
+        Apply the overall thresholds to a list of db matches ([field, likelihood, value, matched db entry]).
+        Returns a Report, or None if nothing hit.
+        """
+        if config is None:
+            config = self.trigger_db["config"]
+        hit = False
+        reason = None
+        if best_match_likelihood >= config["overall_threshold_likelihood"]:
+            hit = True
+            reason = "Exceeded overall likelihood threshold."
+
+        if len(matches) >= config["overall_threshold_flags"]:
+            hit = True
+            reason = "Exceeded flagged fields threshold."
+
+        if not hit:
+            return None
+
+        # Generate response text
+        response_text = f"Reason: {reason}\n\nMatches:\n"
+        for field, likelihood, field_value, matched_value in matches:
+            response_text += f" * {field} = '{field_value}' matched db entry '{matched_value}' with likelihood {likelihood}\n"
+        return Report(user_dict, response_text, best_match_likelihood)
+
+    def on_config_change(self, snapshot):
+        """
+        Settings subscriber: flag the trigger db for an update if anything it is built from changed
+        """
+        goku_config = snapshot.get_config("goku")
+        self.domain_waves.window_seconds = goku_config.get("domain_wave_window", 3600)
+        db_config_key = (snapshot.path_versions.get("goku_raw_db"), goku_config["raw_db_dir"], goku_config["embed_db_file"], tuple(goku_config["image_extensions"]))
+        if db_config_key != self.db_config_key:
+            self.db_config_key = db_config_key
+            self.db_dirty.set()
+
     def update_db(self):
         """
-        Update the trigger database
+        Update the trigger database, if db_raw or the relevant settings changed since the last update
         """
-        # Working copy
-        trigger_db_updated = copy.deepcopy(self.trigger_db)
+        if not self.component_manager.get_component("settings").is_watching():
+            self.component_manager.get_component("settings").poll_changes()
+        if len(glob(self.component_manager.get_component("settings").get_config("goku")["embed_db_file"] + ".import.*.pkl")) > 0:
+            self.db_dirty.set()
+        if not self.db_dirty.is_set() and self.trigger_db["config"] is not None:
+            self.component_manager.get_component("metrics").inc("goku_update_db_skipped_total")
+            return
+        self.db_dirty.clear()
+        try:
+            with self.component_manager.get_component("metrics").timer("goku_stage_seconds", stage="update_db"):
+                self._update_db()
+        except Exception:
+            self.db_dirty.set()
+            raise
+
+    def _update_db(self):
+        goku_config = self.component_manager.get_component("settings").get_config("goku")
+
+        # Working copy of just the parts we rebuild, the rest of the trigger db stays live
+        trigger_db_updated = {
+            "embeds": defaultdict(OrderedDict, {x: OrderedDict(y) for x, y in self.trigger_db["embeds"].items()}),
+            "pre_matrices": dict(self.trigger_db["pre_matrices"]),
+        }
         
         # Update classifier config
-        trigger_db_updated["config"] = json.load(open(Path(self.component_manager.get_component("settings").get_config("goku")["raw_db_dir"]) / "config.json", 'rb'))    
+        trigger_db_updated["config"] = json.load(open(Path(goku_config["raw_db_dir"]) / "config.json", 'rb'))
         
-        # Update embeds
+        # Pick up embeds precomputed by the bulk importer
+        import_files = sorted(glob(goku_config["embed_db_file"] + ".import.*.pkl"))
+        dirty_fields = set()
+        for import_file in import_files:
+            with open(import_file, 'rb') as f:
+                imported_embeds = pickle.load(f)
+            for field, field_embeds in imported_embeds.items():
+                for name, embed in field_embeds.items():
+                    if not name in trigger_db_updated["embeds"][field]:
+                        trigger_db_updated["embeds"][field][name] = embed
+                        dirty_fields.add(field)
+            self.component_manager.get_component("logging").add_log("Goku", "Info", f"Imported embeds from {import_file}")
+
+        # Update embeds, in batches
+        batch_size = goku_config.get("embed_batch_size", 32)
         for field, field_data in trigger_db_updated["config"]["fields"].items():
             self.component_manager.get_component("logging").add_log("Goku", "Trace", f"Updating field {field}")
-            dirty = False
+            dirty = field in dirty_fields
             if field_data["type"] == "image":
-                images = glob_multiple(Path(self.component_manager.get_component("settings").get_config("goku")["raw_db_dir"]) / field, self.component_manager.get_component("settings").get_config("goku")["image_extensions"])
-                for image in images:
-                    name = Path(image).name
-                    if not name in trigger_db_updated["embeds"][field]:
-                        dirty = True
-                        image_data = read_image(image)
-                        trigger_db_updated["embeds"][field][name] = get_image_embed(image_data, self.models["image_preprocessor"], self.models["clip_model"])
-
-            if field_data["type"] == "text":                    
-                field_texts = json.load(open(Path(self.component_manager.get_component("settings").get_config("goku")["raw_db_dir"]) / (field + ".json"), 'rb'))
-                for text in field_texts:
-                    if not text in trigger_db_updated["embeds"][field]:
-                        dirty = True
-                        trigger_db_updated["embeds"][field][text] = get_text_embed(text,self. models["text_tokenizer"], self.models["clip_model"]) 
-                        
+                images = glob_multiple(Path(goku_config["raw_db_dir"]) / field, goku_config["image_extensions"])
+                new_images = [x for x in images if not Path(x).name in trigger_db_updated["embeds"][field]]
+                for batch_start in range(0, len(new_images), batch_size):
+                    dirty = True
+                    batch = new_images[batch_start:batch_start + batch_size]
+                    batch_embeds = self.embed_images([read_image(x) for x in batch])
+                    for image, embed in zip(batch, batch_embeds):
+                        trigger_db_updated["embeds"][field][Path(image).name] = embed
+
+            if field_data["type"] == "text":
+                field_texts = json.load(open(Path(goku_config["raw_db_dir"]) / (field + ".json"), 'rb'))
+                new_texts = [x for x in dict.fromkeys(field_texts) if not x in trigger_db_updated["embeds"][field]]
+                for batch_start in range(0, len(new_texts), batch_size):
+                    dirty = True
+                    batch = new_texts[batch_start:batch_start + batch_size]
+                    for text, embed in zip(batch, self.embed_texts(batch)):
+                        trigger_db_updated["embeds"][field][text] = embed
+
             if dirty:
                 trigger_db_updated["pre_matrices"][field] = np.vstack(list(trigger_db_updated["embeds"][field].values()))
 
         for key in trigger_db_updated["pre_matrices"]:
             self.component_manager.get_component("logging").add_log("Goku", "Trace", f"Matrix shape for {key}: {trigger_db_updated['pre_matrices'][key].shape}")
-        self.trigger_db = trigger_db_updated
+            self.component_manager.get_component("metrics").set_gauge("goku_trigger_db_entries", trigger_db_updated["pre_matrices"][key].shape[0], field=key)
+        self.trigger_db.update(trigger_db_updated)
+
+        # Imports are in the db now, persist before dropping the import files
+        if len(import_files) > 0:
+            self.store_db()
+            for import_file in import_files:
+                os.remove(import_file)
 
     def eval_user(self, user_dict, posts_dicts, update_history = True, check_types = ["account", "status"]):
         """
@@ -192,52 +418,37 @@ class Goku:
         best_match_likelihood = 0.0
         similarity_match_fields = []
         similarity_match_cross = None
+        similarity_match_members = {}
+        similarity_match_clusters = []
+        field_scores = {}
+        score_recorder = self.get_score_recorder() if update_history else None
         for field_raw in self.trigger_db["pre_matrices"]:
             # Find what we want to trigger on
             field_type = field_raw.split(".")[0]
             field = ".".join(field_raw.split(".")[1:])
-            if field_type == "account":
-                check_dict = user_dict
-            elif field_type == "status":
-                check_dict = posts_dicts
-            else:
-                assert False, "Invalid field type: " + str(field_type)
             if not field_type in check_types:
                 continue
-
-            # Find field value
-            self.component_manager.get_component("logging").add_log("Goku", "Trace", f"Checking field {field}")
-            field_val = get_by_path(check_dict, field)
+            field_val = self.get_field_value(field_raw, user_dict, posts_dicts)
             if field_val is None:
                 continue
-            self.component_manager.get_component("logging").add_log("Goku", "Trace", f"Value is {field_val}")
-
-            # Check against ignore list so we don't report for missing ava/header, or being the internal fetch actor
-            if field_val in self.trigger_db["config"]["fields"][field_raw]["ignore"]:
-                continue
-
-            # Bail if below minimum length
-            min_len = 1
-            if self.trigger_db["config"]["fields"][field_raw]["type"] == "text":
-                # Strip html (or rather: anything between <.*>)
-                field_val = re.sub(r'<.*?>', '', field_val)
-                min_len = self.trigger_db["config"]["fields"][field_raw]["min_len"]
-            if len(field_val) < min_len:
-                continue
 
             # Find embed value for field
             field_embed = None
             if self.trigger_db["config"]["fields"][field_raw]["type"] == "image":
-                image = read_image_online(field_val)
+                with self.component_manager.get_component("metrics").timer("goku_stage_seconds", stage="download_media"):
+                    image = read_image_online(field_val)
                 if not image is None:
-                    field_embed = get_image_embed(image, self.models["image_preprocessor"], self.models["clip_model"])
+                    field_embed = self.embed_image(image)
+                else:
+                    self.component_manager.get_component("metrics").inc("goku_media_download_failures_total")
             elif self.trigger_db["config"]["fields"][field_raw]["type"] == "text":
-                field_embed = get_text_embed(field_val, self.models["text_tokenizer"], self.models["clip_model"]) 
+                field_embed = self.embed_text(field_val)
             else:
                 assert False, "Invalid content type"
 
             # Compare with database
             if not field_embed is None:
+                scoring_start = time.perf_counter()
                 cosine_sim_matrix = self.trigger_db["pre_matrices"][field_raw] @ field_embed
                 field_match_likelihood = np.max(cosine_sim_matrix)
                 self.component_manager.get_component("logging").add_log("Goku", "Trace", f"Field {field} - best match with db: {field_match_likelihood}")
@@ -246,167 +457,553 @@ class Goku:
                     matches.append([field, field_match_likelihood, field_val, list(self.trigger_db["embeds"][field_raw].keys())[match_idx]])
                 best_match_likelihood = max(best_match_likelihood, field_match_likelihood)
 
-                # Compare with history
-                if len(self.trigger_db["field_history"][field_raw]) > 0:
-                    history_matrix = np.array([x[1] for x in self.trigger_db["field_history"][field_raw]])
-                    similarity_matches = ((history_matrix @ field_embed) > self.trigger_db["config"]["fields"][field_raw]["threshold_similar"])
-                    if np.sum(similarity_matches) >= self.trigger_db["config"]["similar_users_count_threshold"]:
-                        similarity_match_fields.append(field_raw)
-                        similarity_match_dict = dict(zip(similarity_matches, [x[0] for x in self.trigger_db["field_history"][field_raw]]))
-                        if similarity_match_cross is None:
-                            similarity_match_cross = similarity_match_dict
-                        else:
-                            similarity_match_cross = {x: similarity_match_dict[x] for x in similarity_match_dict.keys() & similarity_match_cross.keys()}
-
-                # Append to history
+                # Compare with recent users: find (or, when updating history, join) the closest wave cluster.
+                # Ids are compared as strings, webhook payloads and the API don't agree on the type.
+                clusterer = self.trigger_db["clusters"].get(field_raw)
+                if clusterer is None and update_history:
+                    clusterer = self.trigger_db["clusters"][field_raw] = WaveClusterer(
+                        self.trigger_db["config"].get("similar_users_max_clusters", 1000),
+                        self.trigger_db["config"].get("similar_users_max_members", 100)
+                    )
+                threshold_similar = self.trigger_db["config"]["fields"][field_raw]["threshold_similar"]
+
+                # Record scores before this user joins a cluster: best db matches, closest cluster and its size
+                if not score_recorder is None:
+                    topk_idx = np.argsort(cosine_sim_matrix)[::-1][:score_recorder.topk]
+                    entry_names = list(self.trigger_db["embeds"][field_raw].keys())
+                    closest_cluster_idx, closest_cluster_similarity = clusterer.match(field_embed)
+                    closest_cluster_count = len([x for x in clusterer.get_members(closest_cluster_idx) if str(x["id"]) != str(user_dict["id"])])
+                    field_scores[field_raw] = (
+                        float(field_match_likelihood),
+                        [entry_names[x] for x in topk_idx],
+                        [float(cosine_sim_matrix[x]) for x in topk_idx],
+                        closest_cluster_similarity,
+                        closest_cluster_count
+                    )
+
+                cluster_members = []
                 if update_history:
-                    self.trigger_db["field_history"][field_raw].append((user_dict, field_embed))
-                    self.trigger_db["field_history"][field_raw] = self.trigger_db["field_history"][field_raw][-self.trigger_db["config"]["similar_users_history_length"]:]
+                    cluster_idx, cluster_similarity = clusterer.add(field_embed, {"id": user_dict["id"], "acct": user_dict["acct"]}, threshold_similar)
+                    cluster_members = clusterer.get_members(cluster_idx)
+                elif not clusterer is None:
+                    cluster_idx, cluster_similarity = clusterer.match(field_embed)
+                    if cluster_similarity >= threshold_similar:
+                        cluster_members = clusterer.get_members(cluster_idx)
+                cluster_members = {str(x["id"]): x for x in cluster_members if str(x["id"]) != str(user_dict["id"])}
+                if len(cluster_members) >= self.trigger_db["config"]["similar_users_count_threshold"]:
+                    similarity_match_fields.append(field_raw)
+                    similarity_match_members.update(cluster_members)
+                    similarity_match_clusters.append((clusterer, cluster_idx))
+                    if similarity_match_cross is None:
+                        similarity_match_cross = cluster_members.keys()
+                    else:
+                        similarity_match_cross = similarity_match_cross & cluster_members.keys()
+                self.component_manager.get_component("metrics").observe("goku_stage_seconds", time.perf_counter() - scoring_start, stage="matrix_scoring")
+
+        if not score_recorder is None:
+            score_recorder.add(user_dict, field_scores, len(similarity_match_cross) if similarity_match_cross is not None else 0)
 
         # See if we hit any match conditions
-        hit = False
-        reason = None
-        if best_match_likelihood >= self.trigger_db["config"]["overall_threshold_likelihood"]:
-            hit = True
-            reason = "Exceeded overall likelihood threshold."
-            
-        if len(matches) >= self.trigger_db["config"]["overall_threshold_flags"]:
-            hit = True
-            reason = "Exceeded flagged fields threshold."
-            
-        # And the conditions for similarity match
-        if len(similarity_match_fields) >= self.trigger_db["config"]["similar_users_threshold_flags"]:
-            # Generate reason string
-            reason = f"Similar count exceeded on fields {similarity_match_fields}. Matching users (matching fields intersection):\n"
-            for is_match, match_dict in similarity_match_cross.items():
-                if is_match:
-                    reason += f" * {match_dict.acct}'\n"
-            # One report for every matching user
-            for is_match, match_dict in similarity_match_cross.items():
-                if is_match:
-                    reports.append(Report(match_dict, reason, best_match_likelihood))
-            reports.append(Report(user_dict, reason, best_match_likelihood))
+        match_report = self.match_report(user_dict, matches, best_match_likelihood)
 
-        # Generate response text
-        response_text = ""
-        if hit:
-            response_text = f"Reason: {reason}\n\nMatches:\n"
-            for field, likelihood, field_value, matched_value in matches:
-                response_text += f" * {field} = '{field_value}' matched db entry '{matched_value}' with likelihood {likelihood}\n"
-            reports.append(Report(user_dict, response_text, best_match_likelihood))
+        # And the conditions for similarity match: enough users that are similar on enough of the same fields
+        if len(similarity_match_fields) >= self.trigger_db["config"]["similar_users_threshold_flags"] and len(similarity_match_cross) >= self.trigger_db["config"]["similar_users_count_threshold"]:
+            wave_members = [similarity_match_members[x] for x in sorted(similarity_match_cross)]
+            reason = f"Similar count exceeded on fields {similarity_match_fields}. Matching users (matching fields intersection):\n"
+            for member in wave_members:
+                reason += f" * {member['acct']}\n"
+            # One consolidated report for the whole wave
+            reports.append(Report(user_dict, reason, best_match_likelihood, wave_members, similarity_match_clusters))
+
+        if not match_report is None:
+            reports.append(match_report)
+        self.component_manager.get_component("metrics").inc("goku_hits_total", len(reports))
         return reports
 
-    def generate_reports(self, reports, allow_suspend=True):
+    def generate_reports(self, reports, allow_suspend=True, nodeinfo=None):
         """
-        File reports for the provided users
+        File reports for the provided users. Instance info comes from nodeinfo (a Piccolo NodeinfoSnapshot)
+        if given, otherwise from Piccolo directly. Returns the number of accounts acted on, that is reported
+        accounts plus wave members that were moderated along with them, for panic stops.
         """
-        reported_count = 0
+        if len(reports) == 0:
+            return 0
+        with self.component_manager.get_component("metrics").timer("goku_stage_seconds", stage="report_filing"):
+            return self._generate_reports(reports, allow_suspend, nodeinfo)
+
+    def _generate_reports(self, reports, allow_suspend, nodeinfo):
+        if nodeinfo is None:
+            nodeinfo = self.component_manager.get_component("piccolo")
+        goku_config = self.component_manager.get_component("settings").get_config("goku")
+        # Claim ids before acting on them, so replicas (or trunks and the main loop) never both report an account
+        reported_set = "goku_reported_ids" if allow_suspend else "goku_reported_ids_nosuspend"
+        state = self.component_manager.get_component("state")
+        acted_count = 0
         for report in reports:
-            report_dict, reason, best_match_likelihood = report.data, report.reason, report.likelihood
+            report_dict, reason, best_match_likelihood, members, clusters = report.data, report.reason, report.likelihood, report.members, report.clusters
+
+            # A wave that was reported already: newcomers are moderated under that report instead of getting their own.
+            # Ones we would take no action on still get a report, so a mod sees them.
+            wave_report_id = next((x.get_report_id(idx) for x, idx in clusters if not x.get_report_id(idx) is None), None)
+            if not wave_report_id is None and not self.wave_member_action(report_dict, best_match_likelihood, allow_suspend, nodeinfo) is None:
+                acted_count += self.moderate_wave_members(wave_report_id, report_dict["acct"], [report_dict] + members, best_match_likelihood, allow_suspend, nodeinfo)
+                continue
+
             # Skip already reported
-            if allow_suspend:
-                if report_dict["id"] in self.trigger_db["reported_ids"]:
-                    continue
-            else:
-                if report_dict["id"] in self.trigger_db["reported_ids_nosuspend"]:
-                    continue
+            if not state.claim(reported_set, report_dict["id"]):
+                self.component_manager.get_component("metrics").inc("goku_already_reported_total")
+                continue
 
             # Log hit
             acct_name = report_dict["acct"]
             self.component_manager.get_component("logging").add_log("Goku", "Info", f"Hit on user {acct_name}\n\n{reason}")
 
-            # File report
+            # File report, giving the claim back if that fails
             if len(reason) > 950:
                 reason = reason[:950]
-            report = self.component_manager.get_component("mastodon").report(report_dict, comment=f"/!\ AUTOMATED DETECTION /!\\\n\nReason: {reason}")
-            reported_count += 1
+            try:
+                report = self.component_manager.get_component("mastodon").report(report_dict, comment=f"/!\ AUTOMATED DETECTION /!\\\n\nReason: {reason}")
+            except Exception:
+                state.set_remove(reported_set, report_dict["id"])
+                raise
+            acted_count += 1
+            self.component_manager.get_component("metrics").inc("goku_reports_total")
+            for clusterer, cluster_idx in clusters:
+                clusterer.set_report_id(cluster_idx, report["id"])
 
             # If desired: Silence user immediately and leave it for mod to unsilence if false positive
-            if self.component_manager.get_component("settings").get_config("goku")["preemptive_silence"] and not self.component_manager.get_component("piccolo").is_closed_regs_instance(report_dict["acct"].split("@")[-1]):
+            if goku_config["preemptive_silence"] and not nodeinfo.is_closed_regs_instance(report_dict["acct"].split("@")[-1]):
                 self.component_manager.get_component("mastodon").admin_account_moderate(report_dict, action="silence", report_id = report)
                 self.component_manager.get_component("mastodon").admin_report_reopen(report)
             
             # If desired: Auto-suspend above a certain likelihood
-            if best_match_likelihood > self.component_manager.get_component("settings").get_config("goku")["preemptive_suspend_thresh"] and not self.component_manager.get_component("piccolo").is_closed_regs_instance(report_dict["acct"].split("@")[-1]):
+            if best_match_likelihood > goku_config["preemptive_suspend_thresh"] and not nodeinfo.is_closed_regs_instance(report_dict["acct"].split("@")[-1]):
                 if allow_suspend:
                     self.component_manager.get_component("mastodon").admin_account_moderate(report_dict, action="suspend", report_id = report)
                     self.component_manager.get_component("mastodon").admin_report_reopen(report)
 
-            # Add to history
-            if allow_suspend:
-                self.trigger_db["reported_ids"].add(report_dict["id"])
+            # Wave members are covered by this report
+            acted_count += self.moderate_wave_members(report["id"], acct_name, members, best_match_likelihood, allow_suspend, nodeinfo)
+        return acted_count
+
+    def wave_member_action(self, member_dict, likelihood, allow_suspend, nodeinfo):
+        """
+        Preemptive action for a member of a wave report ("suspend", "silence" or None)
+        """
+        goku_config = self.component_manager.get_component("settings").get_config("goku")
+        if nodeinfo.is_closed_regs_instance(member_dict["acct"].split("@")[-1]):
+            return None
+        if likelihood > goku_config["preemptive_suspend_thresh"] and allow_suspend:
+            return "suspend"
+        if goku_config["preemptive_silence"]:
+            return "silence"
+        return None
+
+    def moderate_wave_members(self, report_id, acct_name, members, likelihood, allow_suspend, nodeinfo):
+        """
+        Apply the preemptive actions of a wave report to its members, tied to the report so mods can find and
+        undo them. The report comment is truncated, so the full list goes to the log. Returns the number moderated.
+        """
+        reported_set = "goku_reported_ids" if allow_suspend else "goku_reported_ids_nosuspend"
+        state = self.component_manager.get_component("state")
+        moderated_members = []
+        for member_dict in members:
+            if not state.claim(reported_set, member_dict["id"]):
+                continue
+            action = self.wave_member_action(member_dict, likelihood, allow_suspend, nodeinfo)
+            if not action is None:
+                self.component_manager.get_component("mastodon").admin_account_moderate(member_dict, action=action, report_id = report_id)
+                moderated_members.append(f"{member_dict['acct']} ({action})")
+        if len(moderated_members) > 0:
+            self.component_manager.get_component("mastodon").admin_report_reopen(report_id)
+            self.component_manager.get_component("logging").add_log("Goku", "Info", f"Moderated {len(moderated_members)} wave members with report {report_id} (wave hit on {acct_name}):\n" + "\n".join(moderated_members))
+        return len(moderated_members)
+
+    def fetch_new_accounts(self):
+        """
+        Page through the remote account list until we hit an account we have already seen
+        """
+        goku_config = self.component_manager.get_component("settings").get_config("goku")
+        accounts = [ ]
+        self.component_manager.get_component("logging").add_log("Goku", "Info", f"Fetching next user batch, last seen ID was {self.trigger_db['last_checked_user_id']}")
+        with self.component_manager.get_component("metrics").timer("goku_stage_seconds", stage="fetch_accounts"):
+            fetch_accounts = self.component_manager.get_component("mastodon").admin_accounts_v2(origin="remote", status="active")
+        fetched_pages = 1
+        should_abort_fetch = False
+        while fetch_accounts is not None and len(fetch_accounts) > 0 and fetched_pages < goku_config["max_fetch_pages"]:
+            should_abort_fetch = False
+            for account in fetch_accounts:
+                if account.id in self.trigger_db["seen_ids"]:
+                    should_abort_fetch = True
+                else:
+                    accounts.append(account)
+                    self.trigger_db["seen_ids"].append(account.id)
+                    self.trigger_db["seen_ids"] = self.trigger_db["seen_ids"][-goku_config["id_hist_length"]:]
+            if self.trigger_db["last_checked_user_id"] == 0:
+                should_abort_fetch = True
+            if should_abort_fetch:
+                break
+            fetched_pages += 1
+            self.component_manager.get_component("logging").add_log("Goku", "Info", f"Fetching page {fetched_pages}")
+            with self.component_manager.get_component("metrics").timer("goku_stage_seconds", stage="fetch_accounts"):
+                fetch_accounts = self.component_manager.get_component("mastodon").fetch_next(fetch_accounts)
+        if len(accounts) != 0:
+            self.trigger_db["last_checked_user_id"] = np.max([x.id for x in accounts])
+        return accounts
+
+    def check_user(self, user):
+        """
+        Fetch recent posts for one admin account and evaluate it. Returns reports, for check_accounts to file.
+        """
+        goku_config = self.component_manager.get_component("settings").get_config("goku")
+        account_dict = user.account
+        with self.component_manager.get_component("metrics").timer("goku_stage_seconds", stage="fetch_statuses"):
+            account_posts = self.component_manager.get_component("mastodon").account_statuses(account_dict.id, limit=5)
+        if len(account_posts) == 0:
+            # Give posts a moment to federate in
+            time.sleep(goku_config.get("status_retry_wait", 1.0))
+            with self.component_manager.get_component("metrics").timer("goku_stage_seconds", stage="fetch_statuses"):
+                account_posts = self.component_manager.get_component("mastodon").account_statuses(account_dict.id, limit=5)
+        self.component_manager.get_component("logging").add_log("Goku", "Trace", f"Checking user {account_dict.acct} with {len(account_posts)} posts.")
+        with self.component_manager.get_component("metrics").timer("goku_user_seconds"):
+            reports = self.eval_user(account_dict, account_posts)
+        self.component_manager.get_component("metrics").inc("goku_users_checked_total")
+        return reports
+
+    def domain_report(self, domain, reports, nodeinfo):
+        """
+        Collapse the hits from a domain that is in a wave into one report, with all other affected accounts
+        from that domain as members. Optionally limits the domain right away. Wave members from other domains
+        are not covered by this, they go back out as normal reports. Returns the list of reports to file.
+        """
+        goku_config = self.component_manager.get_component("settings").get_config("goku")
+        state = self.component_manager.get_component("state")
+        checked, hits, hit_rate = self.domain_waves.stats(domain)
+        instance_info = nodeinfo.get_nodeinfo(domain)[2]
+        user_count = "unknown"
+        registrations = "unknown"
+        try:
+            user_count = instance_info["usage"]["users"]["total"]
+        except:
+            pass
+        try:
+            registrations = "open" if instance_info["openRegistrations"] else "closed"
+        except:
+            pass
+
+        # All affected accounts on the domain, the most likely hit first, without those already handled
+        reports = sorted(reports, key = lambda x: x.likelihood, reverse = True)
+        accounts = {}
+        other_reports = []
+        for report in reports:
+            other_members = []
+            for account_dict in [report.data] + report.members:
+                if not account_dict["acct"].endswith("@" + domain):
+                    other_members.append(account_dict)
+                elif not account_dict["id"] in accounts and not state.set_contains("goku_reported_ids", account_dict["id"]):
+                    accounts[account_dict["id"]] = account_dict
+            if len(other_members) > 0:
+                other_reason = f"Similar users, from a wave that is otherwise covered by the domain report for {domain}. Matching users:\n"
+                for member in other_members[1:]:
+                    other_reason += f" * {member['acct']}\n"
+                other_reports.append(Report(other_members[0], other_reason, report.likelihood, other_members[1:], report.clusters))
+        if len(accounts) == 0:
+            return other_reports
+        accounts = list(accounts.values())
+
+        first_in_window = self.domain_waves.mark_wave(domain)
+        limited = domain in self.limited_domains
+        if first_in_window:
+            self.component_manager.get_component("metrics").inc("goku_domain_waves_total")
+            self.component_manager.get_component("logging").add_log("Goku", "Info", f"Domain wave from {domain}: {hits} hits in {checked} checked accounts ({hit_rate:.1f}/h), {user_count} users, registrations {registrations}. Recommend limiting {domain}.")
+            if goku_config.get("domain_wave_auto_limit", False) and registrations != "closed" and not limited:
+                self.component_manager.get_component("mastodon").admin_create_domain_block(domain, severity = "silence", private_comment = f"Goku: automated limit, spam wave of {hits} accounts in {self.domain_waves.window_seconds / 60:.0f} minutes")
+                self.component_manager.get_component("logging").add_log("Goku", "Info", f"Limited {domain}")
+                self.limited_domains.add(domain)
+                limited = True
+
+        # If the whole domain is limited, the accounts need no moderation of their own
+        members = accounts[1:]
+        if limited:
+            for member_dict in members:
+                state.claim("goku_reported_ids", member_dict["id"])
+            members = []
+
+        shown_accounts = ", ".join(x["acct"] for x in accounts[:20])
+        if len(accounts) > 20:
+            shown_accounts += f" and {len(accounts) - 20} more"
+        reason = f"Domain wave: {hits} of {checked} accounts checked from {domain} in the last {self.domain_waves.window_seconds / 60:.0f} minutes matched ({hit_rate:.1f}/h).\n"
+        reason += f"Instance has {user_count} users, registrations {registrations}. " + (f"{domain} has been limited automatically." if limited else f"Recommendation: limit {domain}.") + "\n"
+        reason += f"Affected accounts ({len(accounts)}): {shown_accounts}\n\n"
+        reason += reports[0].reason
+        return [Report(accounts[0], reason, reports[0].likelihood, members)] + other_reports
+
+    def file_batch_reports(self, pending_reports, nodeinfo):
+        """
+        File reports for a batch of checked accounts, given as (domain, report) pairs. Hits from domains
+        that are in a wave go out as one consolidated report per domain, the rest one by one.
+        Returns the number of accounts acted on, see generate_reports.
+        """
+        goku_config = self.component_manager.get_component("settings").get_config("goku")
+        domain_reports = defaultdict(list)
+        for domain, report in pending_reports:
+            domain_reports[domain].append(report)
+        reports = []
+        for domain, reports_for_domain in domain_reports.items():
+            if domain is not None and self.domain_waves.is_wave(domain, goku_config.get("domain_wave_min_hits", 5), goku_config.get("domain_wave_min_hit_ratio", 0.5)):
+                reports += self.domain_report(domain, reports_for_domain, nodeinfo)
             else:
-                self.trigger_db["reported_ids_nosuspend"] = self.trigger_db["reported_ids_nosuspend"] | {report_dict["id"]}
-        return reported_count
+                reports += reports_for_domain
+        return self.generate_reports(reports, nodeinfo = nodeinfo)
 
-    def user_check_loop(self):
+    def prefetch_nodeinfo(self, accounts):
+        """
+        Instance info for all domains in a batch of admin accounts, fetched up front and in parallel
+        """
+        piccolo_config = self.component_manager.get_component("settings").get_config("piccolo")
+        return self.component_manager.get_component("piccolo").prefetch_nodeinfo(
+            [x.account.acct.split("@")[-1] for x in accounts if "@" in x.account.acct],
+            max_workers = piccolo_config.get("prefetch_workers", 16),
+            timeout = piccolo_config.get("prefetch_timeout", 10)
+        )
+
+    def get_score_recorder(self):
+        """
+        Score recorder for the configured directory, or None if recording is off
+        """
+        goku_config = self.component_manager.get_component("settings").get_config("goku")
+        record_dir = goku_config.get("score_record_dir", "")
+        if self.score_recorder is not None and str(self.score_recorder.directory) != str(Path(record_dir)):
+            self.score_recorder.flush()
+            self.score_recorder = None
+        if self.score_recorder is None and record_dir != "":
+            self.score_recorder = ScoreRecorder(record_dir, goku_config.get("score_record_topk", 3))
+        return self.score_recorder
+
+    def store_db(self):
         """
-        The actual user checker loop
+        Store trigger db cache
         """
+        with self.component_manager.get_component("metrics").timer("goku_stage_seconds", stage="pickling"):
+            # A non-persistent state backend loses the reported ids on restart, keep them in the pickle
+            # (they are moved back into the backend on load)
+            trigger_db = self.trigger_db
+            state = self.component_manager.get_component("state")
+            if not state.persistent:
+                trigger_db = dict(self.trigger_db)
+                trigger_db["reported_ids"] = state.set_members("goku_reported_ids")
+                trigger_db["reported_ids_nosuspend"] = state.set_members("goku_reported_ids_nosuspend")
+
+            # Atomic-write, replicas may share the file
+            embed_db_file = self.component_manager.get_component("settings").get_config("goku")["embed_db_file"]
+            with open(embed_db_file + f".{os.getpid()}.tmp", 'wb') as f:
+                pickle.dump(trigger_db, f, protocol = pickle.HIGHEST_PROTOCOL)
+            os.replace(embed_db_file + f".{os.getpid()}.tmp", embed_db_file)
+
+    def store_poll_cursor(self):
+        """
+        Share where polling got to, so another replica can pick up from there if it becomes leader
+        """
+        self.component_manager.get_component("state").kv_set("goku", "poll_cursor", {
+            "seen_ids": list(self.trigger_db["seen_ids"]),
+            "last_checked_user_id": self.trigger_db["last_checked_user_id"],
+        })
+
+    def update_leadership(self):
+        """
+        Take or renew the leader lease. Returns True if this replica is the leader.
+        """
+        lease_seconds = self.component_manager.get_component("settings").get_config("goku").get("leader_lease_seconds", 60)
+        is_leader = self.component_manager.get_component("state").acquire_lease("goku_user_check", self.replica_id, lease_seconds)
+        self.lease_renewed = time.time()
+        if is_leader and not self.is_leader:
+            self.component_manager.get_component("logging").add_log("Goku", "Info", f"Replica {self.replica_id} is now leader")
+            poll_cursor = self.component_manager.get_component("state").kv_get("goku", "poll_cursor")
+            if poll_cursor is not None:
+                self.trigger_db.update(poll_cursor)
+        elif self.is_leader and not is_leader:
+            self.component_manager.get_component("logging").add_log("Goku", "Warn", f"Replica {self.replica_id} lost leadership")
+        self.is_leader = is_leader
+        return is_leader
+
+    def check_cycle(self):
+        """
+        One pass of the user checker: update db, fetch new users, check them.
+        Returns the number of users checked.
+        """
+        # Update trigger database
+        self.update_db()
+
+        # Get new users
+        accounts = self.fetch_new_accounts()
+        self.component_manager.get_component("logging").add_log("Goku", "Info", f"Checking {len(accounts)} new users.")
+
+        # Store trigger db cache
+        self.store_db()
+        self.store_poll_cursor()
+
+        # Check users
+        self.check_accounts(accounts)
+
+        # Store trigger db cache with updated histories
+        self.store_db()
+        return len(accounts)
+
+    def check_accounts(self, accounts):
+        """
+        Check a list of admin accounts, stopping the component if too many reports get filed
+        """
+        self.busy.set()
+        goku_config = self.component_manager.get_component("settings").get_config("goku")
+        try:
+            nodeinfo = self.prefetch_nodeinfo(accounts)
+            lease_seconds = goku_config.get("leader_lease_seconds", 60)
+            chunk_size = goku_config.get("domain_wave_chunk_size", 20)
+            for chunk_start in range(0, len(accounts), chunk_size):
+                self.component_manager.get_component("metrics").set_gauge("goku_pending_accounts", len(accounts) - chunk_start)
+                if self.is_leader and time.time() - self.lease_renewed > lease_seconds / 3.0:
+                    self.update_leadership()
+
+                # Check a chunk, counting hits per domain, then file its reports
+                pending_reports = []
+                for user in accounts[chunk_start:chunk_start + chunk_size]:
+                    domain = user.account.acct.split("@")[-1] if "@" in user.account.acct else None
+                    reports = self.check_user(user)
+                    if domain is not None:
+                        self.domain_waves.observe(domain, len(reports) > 0)
+                    pending_reports += [(domain, x) for x in reports]
+                self.panic_count += self.file_batch_reports(pending_reports, nodeinfo)
+                if self.panic_count >= goku_config["panic_stop"]:
+                    self.component_manager.get_component("logging").add_log("Goku", "Info", "Panic - reporting users at too great a rate. Stopping component.")
+                    self._stop_request.set()
+                    break
+        finally:
+            self.busy.clear()
+            self.component_manager.get_component("metrics").set_gauge("goku_pending_accounts", 0)
+
+    def enqueue_account(self, account_id):
+        """
+        Queue an account for checking (e.g. from an account.created webhook). Returns False if the queue is full.
+        """
+        try:
+            self.account_queue.put_nowait(account_id)
+            return True
+        except queue.Full:
+            self.component_manager.get_component("metrics").inc("goku_account_queue_dropped_total")
+            return False
+
+    def process_account_queue(self, until = None):
+        """
+        Check queued accounts as they come in. Blocks until the given time (or returns once the queue is empty if None).
+        Returns the number of users checked.
+        """
+        goku_config = self.component_manager.get_component("settings").get_config("goku")
+        checked = 0
         while not self._stop_request.is_set():
             try:
-                # Update trigger database
-                self.update_db()
-
-                # Get new users
-                accounts = [ ]
-                self.component_manager.get_component("logging").add_log("Goku", "Info", f"Fetching next user batch, last seen ID was {self.trigger_db['last_checked_user_id']}")
-                fetch_accounts = self.component_manager.get_component("mastodon").admin_accounts_v2(origin="remote", status="active")
-                fetched_pages = 1
-                should_abort_fetch = False
-                while len(fetch_accounts) > 0 and fetched_pages < self.component_manager.get_component("settings").get_config("goku")["max_fetch_pages"]:
-                    should_abort_fetch = False
-                    for account in fetch_accounts:
-                        if account.id in self.trigger_db["seen_ids"]:
-                            should_abort_fetch = True
-                        else:
-                            accounts.append(account)
-                            self.trigger_db["seen_ids"].append(account.id)
-                            self.trigger_db["seen_ids"] = self.trigger_db["seen_ids"][-self.component_manager.get_component("settings").get_config("goku")["id_hist_length"]:]
-                    if self.trigger_db["last_checked_user_id"] == 0:
-                        should_abort_fetch = True
-                    if should_abort_fetch:
+                if until is None:
+                    account_id = self.account_queue.get_nowait()
+                else:
+                    timeout = until - time.time()
+                    if timeout <= 0:
                         break
-                    fetched_pages += 1
-                    self.component_manager.get_component("logging").add_log("Goku", "Info", f"Fetching page {fetched_pages}")
-                    fetch_accounts = self.component_manager.get_component("mastodon").fetch_next(fetch_accounts)
-                if len(accounts) != 0:
-                    self.trigger_db["last_checked_user_id"] = np.max([x.id for x in accounts])
-                self.component_manager.get_component("logging").add_log("Goku", "Info", f"Checking {len(accounts)} new users.")
-
-                # Store trigger db cache
-                with open(self.component_manager.get_component("settings").get_config("goku")["embed_db_file"], 'wb') as f:
-                    pickle.dump(self.trigger_db, f, protocol = pickle.HIGHEST_PROTOCOL)
-
-                # Check users
-                panic_stop = 0
-                for user in accounts:
-                    account_dict = user.account
-                    account_posts = self.component_manager.get_component("mastodon").account_statuses(account_dict.id, limit=5)
-                    if len(account_posts) == 0:
-                        time.sleep(1.0)
-                        account_posts = self.component_manager.get_component("mastodon").account_statuses(account_dict.id, limit=5)
-                    self.component_manager.get_component("logging").add_log("Goku", "Trace", f"Checking user {account_dict.acct} with {len(account_posts)} posts.")
-                    reports = self.eval_user(account_dict, account_posts)
-                    panic_stop += self.generate_reports(reports)
-                    if panic_stop >= self.component_manager.get_component("settings").get_config("goku")["panic_stop"]:
-                        self.component_manager.get_component("logging").add_log("Goku", "Info", "Panic - reporting users at too great a rate. Stopping component.")
-                        self._stop_request.set()
-
-                # Store trigger db cache with updated histories
-                with open(self.component_manager.get_component("settings").get_config("goku")["embed_db_file"], 'wb') as f:
-                    pickle.dump(self.trigger_db, f, protocol = pickle.HIGHEST_PROTOCOL)
-
-                # Wait until next period
-                self.component_manager.get_component("logging").add_log("Goku", "Info", "Entering waiting state")
-                wait_time_start = time.time()
-                while not self._stop_request.is_set() and time.time() - wait_time_start < self.component_manager.get_component("settings").get_config("goku")["wait_time"]:
-                    time.sleep(1.0)
+                    account_id = self.account_queue.get(timeout = min(timeout, 1.0))
+            except queue.Empty:
+                if until is None:
+                    break
+                continue
+
+            # Grab whatever else arrived in the meantime, skip what we have already seen
+            account_ids = [account_id]
+            while True:
+                try:
+                    account_ids.append(self.account_queue.get_nowait())
+                except queue.Empty:
+                    break
+            # An account that can't be fetched (e.g. deleted in the meantime) is skipped, not the whole batch
+            accounts = {}
+            for account_id in account_ids:
+                if account_id in self.trigger_db["seen_ids"] or account_id in accounts:
+                    continue
+                try:
+                    with self.component_manager.get_component("metrics").timer("goku_stage_seconds", stage="fetch_accounts"):
+                        account = self.component_manager.get_component("mastodon").admin_account(account_id)
+                except Exception as e:
+                    self.component_manager.get_component("logging").add_log("Goku", "Warn", f"Could not fetch queued account {account_id}, skipping: {e}")
+                    self.component_manager.get_component("metrics").inc("goku_account_fetch_failures_total")
+                    continue
+                accounts[account_id] = account
+            accounts = list(accounts.values())
+
+            # Only mark accounts as seen once they have been checked, so the poll picks them up if checking fails
+            if len(accounts) > 0:
+                self.component_manager.get_component("logging").add_log("Goku", "Info", f"Checking {len(accounts)} queued users.")
+                self.check_accounts(accounts)
+                self.trigger_db["seen_ids"] += [account.id for account in accounts]
+                self.trigger_db["seen_ids"] = self.trigger_db["seen_ids"][-goku_config["id_hist_length"]:]
+                checked += len(accounts)
+        self.accounts_since_poll += checked
+        return checked
+
+    def next_poll_interval(self, poll_interval, activity):
+        """
+        Polling only: fixed wait_time. With event ingestion, polling is a fallback that backs off while
+        idle and speeds up while accounts keep coming in (via either the poll or the event queue).
+        """
+        goku_config = self.component_manager.get_component("settings").get_config("goku")
+        if goku_config.get("ingest_mode", "poll") != "events":
+            return goku_config["wait_time"]
+        min_wait_time = goku_config.get("min_wait_time", 5)
+        max_wait_time = goku_config.get("max_wait_time", 300)
+        if poll_interval is None:
+            return min_wait_time
+        if activity == 0:
+            return min(poll_interval * 2.0, max_wait_time)
+        return max(poll_interval / 2.0, min_wait_time)
+
+    def user_check_loop(self):
+        """
+        The actual user checker loop. Every replica handles its own queued accounts, only the leader polls.
+        """
+        poll_interval = None
+        next_poll_time = 0.0
+        while not self._stop_request.is_set():
+            try:
+                goku_config = self.component_manager.get_component("settings").get_config("goku")
+                lease_seconds = goku_config.get("leader_lease_seconds", 60)
+                self.update_leadership()
+
+                # Panic stop counts per poll period, for standbys (that only work off their queue) too
+                if time.time() >= next_poll_time:
+                    self.panic_count = 0
+                if time.time() >= next_poll_time and not self.is_leader:
+                    # Standby: keep the trigger db current for webhooks
+                    self.update_db()
+                    next_poll_time = time.time() + self.next_poll_interval(None, 0)
+                elif time.time() >= next_poll_time:
+                    with self.component_manager.get_component("metrics").timer("goku_cycle_seconds"):
+                        checked = self.check_cycle()
+                    self.cycle_count += 1
+
+                    # Schedule next poll
+                    poll_interval = self.next_poll_interval(poll_interval, checked + self.accounts_since_poll)
+                    self.accounts_since_poll = 0
+                    next_poll_time = time.time() + poll_interval
+                    self.component_manager.get_component("metrics").set_gauge("goku_poll_interval_seconds", poll_interval)
+                    self.component_manager.get_component("logging").add_log("Goku", "Info", f"Entering waiting state, next poll in {poll_interval:.0f}s")
+
+                # Wait until next period (or lease renewal), handling queued accounts as they come in
+                self.process_account_queue(until = min(next_poll_time, time.time() + lease_seconds / 3.0))
             except Exception:
                 exc_str = traceback.format_exc()
                 self.component_manager.get_component("logging").add_log("Goku", "Error", f"An error occurred in the user check loop: {exc_str}")
                 time.sleep(1.0)
 
+        if self.is_leader:
+            self.component_manager.get_component("state").release_lease("goku_user_check", self.replica_id)
+            self.is_leader = False
+        if not self.score_recorder is None:
+            self.score_recorder.flush()
         self.component_manager.get_component("logging").add_log("Goku", "Info", "Component stopped")
         self._is_running.clear()
         self._stop_request.clear()
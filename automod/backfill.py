@@ -0,0 +1,307 @@
+# Resumable backfill scan of existing remote accounts against newly added trigger db entries
+
+import os
+import time
+import pickle
+import threading
+import traceback
+from shutil import move
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from automod.automod import read_image_online
+
+class RateLimiter:
+    """
+    Spaces out calls so there are at most rate per second on average (rate <= 0 means no limit)
+    """
+    def __init__(self, rate, stop_event = None):
+        self.rate = rate
+        self.stop_event = stop_event
+        self.next_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self, count = 1):
+        if self.rate <= 0:
+            return
+        with self.lock:
+            now = time.monotonic()
+            wait_until = max(self.next_time, now)
+            self.next_time = wait_until + count / self.rate
+        delay = wait_until - now
+        if delay > 0:
+            if self.stop_event is not None:
+                self.stop_event.wait(delay)
+            else:
+                time.sleep(delay)
+
+class Trunks:
+    """
+    It's Trunks, the Time-Reversed User Name and Kontent Scanner.
+
+    Pages back through all remote accounts and checks them against only those trigger db entries that were
+    added since the last completed run. Progress is checkpointed per page, so a stopped run resumes where it left off.
+    """
+    def __init__(self, component_manager):
+        self.component_manager = component_manager
+        self._is_running = threading.Event()
+        self._stop_request = threading.Event()
+        self._worker_thread = None
+        self.cycle_count = 0
+
+        # db_snapshot: field -> db entries already covered by a completed run, run: state of the current run
+        self.checkpoint = {
+            "db_snapshot": { },
+            "run": None,
+        }
+        checkpoint_file = self.get_trunks_config().get("checkpoint_file", "automod/backfill.pkl")
+        if os.path.exists(checkpoint_file):
+            with open(checkpoint_file, 'rb') as f:
+                self.checkpoint.update(pickle.load(f))
+
+        self.component_manager.get_component("metrics").register_gauge("trunks_run_checked", lambda: self.checkpoint["run"]["checked"] if self.checkpoint["run"] is not None else 0)
+
+    def start(self):
+        """
+        Start thread, if not running
+        """
+        if not self._is_running.is_set():
+            self.component_manager.get_component("logging").add_log("Trunks", "Info", "Starting component")
+            self._stop_request.clear()
+            self._is_running.set()
+            self._worker_thread = threading.Thread(target=self.backfill_loop, daemon=True)
+            self._worker_thread.start()
+
+    def stop(self):
+        self._stop_request.set()
+        self.component_manager.get_component("logging").add_log("Trunks", "Info", "Stop requested")
+        if self._worker_thread:
+            self._worker_thread.join()
+
+    def state(self):
+        if not self._is_running.is_set():
+            self._stop_request.clear()
+        if self._stop_request.is_set():
+            return "stop_requested"
+        if self._is_running.is_set():
+            run = self.checkpoint["run"]
+            if run is not None:
+                return f"running (checked {run['checked']}, reported {run['reports']})"
+            return "running"
+        return "stopped"
+
+    def get_trunks_config(self):
+        """
+        Trunks config section, empty if the config predates trunks (every key has a default)
+        """
+        return self.component_manager.get_component("settings").get_config().get("trunks", {})
+
+    def store_checkpoint(self):
+        """
+        Atomic-write checkpoint
+        """
+        checkpoint_file = self.get_trunks_config().get("checkpoint_file", "automod/backfill.pkl")
+        with open(checkpoint_file + ".tmp", 'wb') as f:
+            pickle.dump(self.checkpoint, f, protocol = pickle.HIGHEST_PROTOCOL)
+        move(checkpoint_file + ".tmp", checkpoint_file)
+
+    def compute_delta(self):
+        """
+        Db entries (per field) that no completed run has checked against yet
+        """
+        goku = self.component_manager.get_component("goku")
+        delta = {}
+        for field_raw, embeds in list(goku.trigger_db["embeds"].items()):
+            if not field_raw in goku.trigger_db["config"]["fields"]:
+                continue
+            snapshot = self.checkpoint["db_snapshot"].get(field_raw, set())
+            new_entries = [x for x in embeds.keys() if not x in snapshot]
+            if len(new_entries) > 0:
+                delta[field_raw] = new_entries
+        return delta
+
+    def delta_matrices(self, delta):
+        """
+        Embedding matrices for just the delta entries: field -> (entry names, matrix)
+        """
+        goku = self.component_manager.get_component("goku")
+        matrices = {}
+        for field_raw, entries in delta.items():
+            entries = [x for x in entries if x in goku.trigger_db["embeds"][field_raw]]
+            if len(entries) > 0:
+                matrices[field_raw] = (entries, np.vstack([goku.trigger_db["embeds"][field_raw][x] for x in entries]))
+        return matrices
+
+    def yield_to_goku(self):
+        """
+        Real-time checks go first: wait while goku is working through accounts
+        """
+        if not self.get_trunks_config().get("yield_to_goku", True):
+            return
+        goku = self.component_manager.get_component("goku")
+        while not self._stop_request.is_set() and (goku.busy.is_set() or goku.account_queue.qsize() > 0):
+            self._stop_request.wait(0.5)
+
+    def check_batch(self, accounts, matrices, pool, api_limiter):
+        """
+        Check a batch of admin accounts against the delta matrices. Statuses and media are fetched in parallel,
+        embeddings are computed in one batch per content type. Returns reports.
+        """
+        goku = self.component_manager.get_component("goku")
+        mastodon = self.component_manager.get_component("mastodon")
+        metrics = self.component_manager.get_component("metrics")
+        account_dicts = [x.account for x in accounts]
+
+        # Statuses only if we have status fields to check
+        posts = [[] for _ in account_dicts]
+        if any(x.startswith("status.") for x in matrices):
+            def fetch_statuses(account_dict):
+                api_limiter.wait()
+                return mastodon.account_statuses(account_dict.id, limit=5)
+            with metrics.timer("trunks_stage_seconds", stage="fetch_statuses"):
+                posts = list(pool.map(fetch_statuses, account_dicts))
+
+        # Collect values to check
+        image_values = []
+        text_values = []
+        for account_idx, account_dict in enumerate(account_dicts):
+            for field_raw in matrices:
+                field_val = goku.get_field_value(field_raw, account_dict, posts[account_idx])
+                if field_val is None:
+                    continue
+                if goku.trigger_db["config"]["fields"][field_raw]["type"] == "image":
+                    image_values.append((account_idx, field_raw, field_val))
+                else:
+                    text_values.append((account_idx, field_raw, field_val))
+
+        # Embed
+        embedded = []
+        if len(image_values) > 0:
+            with metrics.timer("trunks_stage_seconds", stage="download_media"):
+                images = list(pool.map(read_image_online, [x[2] for x in image_values]))
+            image_values = [value for value, image in zip(image_values, images) if not image is None]
+            images = [image for image in images if not image is None]
+            if len(images) > 0:
+                embedded += list(zip(image_values, goku.embed_images(images)))
+        if len(text_values) > 0:
+            embedded += list(zip(text_values, goku.embed_texts([x[2] for x in text_values])))
+
+        # Score against delta entries, one matrix product per field
+        matches = [[] for _ in account_dicts]
+        best_match_likelihoods = [0.0] * len(account_dicts)
+        with metrics.timer("trunks_stage_seconds", stage="matrix_scoring"):
+            for field_raw, (entries, matrix) in matrices.items():
+                field_embedded = [(value, embed) for value, embed in embedded if value[1] == field_raw]
+                if len(field_embedded) == 0:
+                    continue
+                similarities = np.vstack([x[1] for x in field_embedded]) @ matrix.T
+                best_idx = np.argmax(similarities, axis=1)
+                best = similarities[np.arange(len(best_idx)), best_idx]
+                field = ".".join(field_raw.split(".")[1:])
+                for (account_idx, _, field_val), likelihood, match_idx in zip([x[0] for x in field_embedded], best, best_idx):
+                    if likelihood >= goku.trigger_db["config"]["fields"][field_raw]["threshold"]:
+                        matches[account_idx].append([field, likelihood, field_val, entries[match_idx]])
+                    best_match_likelihoods[account_idx] = max(best_match_likelihoods[account_idx], likelihood)
+
+        reports = []
+        for account_idx, account_dict in enumerate(account_dicts):
+            report = goku.match_report(account_dict, matches[account_idx], best_match_likelihoods[account_idx])
+            if not report is None:
+                report.reason = "Backfill check against newly added db entries.\n" + report.reason
+                reports.append(report)
+        return reports
+
+    def backfill_loop(self):
+        """
+        One backfill run, resumed from the checkpoint if there is one
+        """
+        try:
+            trunks_config = self.get_trunks_config()
+            goku = self.component_manager.get_component("goku")
+            mastodon = self.component_manager.get_component("mastodon")
+            if goku.trigger_db["config"] is None:
+                self.component_manager.get_component("logging").add_log("Trunks", "Warn", "Goku trigger db not loaded yet, start goku first.")
+                return
+
+            # Start a new run if there isn't one to resume
+            if self.checkpoint["run"] is None:
+                delta = self.compute_delta()
+                if len(delta) == 0:
+                    self.component_manager.get_component("logging").add_log("Trunks", "Info", "No new db entries since the last backfill, nothing to do.")
+                    return
+                self.checkpoint["run"] = {"delta": delta, "max_id": None, "checked": 0, "reports": 0, "started": time.time()}
+                self.store_checkpoint()
+            run = self.checkpoint["run"]
+            matrices = self.delta_matrices(run["delta"])
+            self.component_manager.get_component("logging").add_log("Trunks", "Info", f"Backfilling against {sum(len(x[0]) for x in matrices.values())} new db entries, resuming below id {run['max_id']}")
+
+            # Panic stop counts what this start acted on, run["reports"] carries over from earlier starts
+            panic_count = 0
+            account_limiter = RateLimiter(trunks_config.get("max_accounts_per_second", 10), self._stop_request)
+            api_limiter = RateLimiter(trunks_config.get("max_api_calls_per_second", 2), self._stop_request)
+            finished = False
+            failures = 0
+            page_reports = 0
+            with ThreadPoolExecutor(trunks_config.get("workers", 4)) as pool:
+                while not self._stop_request.is_set():
+                    # Errors (rate limits, server errors, ...) retry the page with backoff, only repeated ones end the run
+                    try:
+                        api_limiter.wait()
+                        with self.component_manager.get_component("metrics").timer("trunks_stage_seconds", stage="fetch_accounts"):
+                            page = mastodon.admin_accounts_v2(origin="remote", status="active", max_id=run["max_id"], limit=trunks_config.get("page_size", 100))
+                        if page is None or len(page) == 0:
+                            finished = True
+                            break
+
+                        page_checked = 0
+                        for batch_start in range(0, len(page), trunks_config.get("batch_size", 32)):
+                            self.yield_to_goku()
+                            if self._stop_request.is_set():
+                                break
+                            batch = page[batch_start:batch_start + trunks_config.get("batch_size", 32)]
+                            account_limiter.wait(len(batch))
+                            reports = self.check_batch(batch, matrices, pool, api_limiter)
+                            if len(reports) > 0:
+                                acted_count = goku.generate_reports(reports, nodeinfo = goku.prefetch_nodeinfo(batch))
+                                page_reports += acted_count
+                                panic_count += acted_count
+                            page_checked += len(batch)
+                            self.component_manager.get_component("metrics").inc("trunks_accounts_checked_total", len(batch))
+                            if panic_count >= trunks_config.get("panic_stop", 50):
+                                self.component_manager.get_component("logging").add_log("Trunks", "Info", "Panic - backfill reported too many users. Stopping component.")
+                                self._stop_request.set()
+                    except Exception:
+                        failures += 1
+                        self.component_manager.get_component("metrics").inc("trunks_page_failures_total")
+                        exc_str = traceback.format_exc()
+                        if failures >= trunks_config.get("max_page_retries", 5):
+                            self.component_manager.get_component("logging").add_log("Trunks", "Error", f"Backfill page below id {run['max_id']} failed {failures} times, giving up: {exc_str}")
+                            break
+                        self.component_manager.get_component("logging").add_log("Trunks", "Warn", f"Backfill page below id {run['max_id']} failed, retrying: {exc_str}")
+                        self._stop_request.wait(min(2.0 ** failures, 300.0))
+                        continue
+
+                    # Only move the cursor (and count the page) once the whole page is done, a partial page gets redone on resume
+                    if not self._stop_request.is_set():
+                        run["max_id"] = min(page, key=lambda x: int(x.id)).id
+                        run["checked"] += page_checked
+                        run["reports"] += page_reports
+                        page_reports = 0
+                        failures = 0
+                        self.store_checkpoint()
+                        self.cycle_count += 1
+
+            if finished:
+                for field_raw, entries in run["delta"].items():
+                    self.checkpoint["db_snapshot"][field_raw] = self.checkpoint["db_snapshot"].get(field_raw, set()) | set(entries)
+                self.checkpoint["run"] = None
+                self.store_checkpoint()
+                self.component_manager.get_component("logging").add_log("Trunks", "Info", f"Backfill finished, checked {run['checked']} users, filed {run['reports']} reports.")
+        except Exception:
+            exc_str = traceback.format_exc()
+            self.component_manager.get_component("logging").add_log("Trunks", "Error", f"An error occurred in the backfill loop: {exc_str}")
+        finally:
+            self.component_manager.get_component("logging").add_log("Trunks", "Info", "Component stopped")
+            self._is_running.clear()
+            self._stop_request.clear()
@@ -0,0 +1,194 @@
+# Offline bulk import of large image corpora into the trigger db
+#
+# Usage (from the repository root):
+#   python -m automod.bulk_import --field account.avatar --corpus path/to/avatars
+#   python -m automod.bulk_import --manifest corpus.json --workers 8 --batch-size 256
+#
+# A manifest is a json list of {"path": ..., "field": ...} objects (field defaults to --field).
+# Images are deduplicated by content hash and named by it, decoded and preprocessed in a process pool
+# and embedded in large batches. Finished embeddings are written next to goku's embed db as an import
+# file, which the running component merges on its next db update without recomputing anything.
+
+import os
+import json
+import time
+import pickle
+import hashlib
+import argparse
+import multiprocessing
+from pathlib import Path
+from shutil import copyfile, move
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import torch
+
+from automod.automod import load_models, read_image, glob_multiple
+
+def hash_file(path):
+    """
+    (path, sha256 of the file contents)
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return path, digest.hexdigest()
+
+# Preprocessing worker state, set once per process
+_worker_preprocessor = None
+
+def init_preprocess_worker(image_preprocessor):
+    global _worker_preprocessor
+    _worker_preprocessor = image_preprocessor
+    torch.set_num_threads(1)
+
+def preprocess_image(path):
+    """
+    Decode and preprocess in a worker process, returns (path, array) or (path, None) for unreadable images
+    """
+    try:
+        return path, _worker_preprocessor(read_image(path)).numpy()
+    except Exception:
+        return path, None
+
+def collect_sources(args, image_extensions):
+    """
+    field -> list of image paths, from the corpus directory or the manifest
+    """
+    sources = {}
+    if args.manifest is not None:
+        manifest_dir = Path(args.manifest).parent
+        for entry in json.load(open(args.manifest, 'rb')):
+            if isinstance(entry, str):
+                entry = {"path": entry}
+            field = entry.get("field", args.field)
+            if field is None:
+                raise SystemExit(f"No field for manifest entry {entry['path']} and no --field given")
+            sources.setdefault(field, []).append(str(manifest_dir / entry["path"]))
+    else:
+        images = []
+        for root, _, _ in os.walk(args.corpus):
+            images += glob_multiple(root, image_extensions)
+        sources[args.field] = sorted(images)
+    return sources
+
+def store_checkpoint(checkpoint_file, checkpoint):
+    """
+    Atomic-write checkpoint
+    """
+    with open(checkpoint_file + ".tmp", 'wb') as f:
+        pickle.dump(checkpoint, f, protocol = pickle.HIGHEST_PROTOCOL)
+    move(checkpoint_file + ".tmp", checkpoint_file)
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk import images into the Goku trigger db")
+    parser.add_argument("--config", default="global_config.json", help="app config, for the goku db paths")
+    parser.add_argument("--field", default=None, help="image field to import into, e.g. account.avatar")
+    parser.add_argument("--corpus", default=None, help="directory of images (searched recursively)")
+    parser.add_argument("--manifest", default=None, help="json list of {path, field}")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--batch-size", type=int, default=128)
+    parser.add_argument("--checkpoint", default=None, help="defaults to the embed db file + .import.ckpt")
+    parser.add_argument("--checkpoint-every", type=int, default=20, help="batches between checkpoints")
+    args = parser.parse_args()
+    if (args.corpus is None) == (args.manifest is None):
+        raise SystemExit("Need exactly one of --corpus and --manifest")
+    if args.corpus is not None and args.field is None:
+        raise SystemExit("--corpus needs --field")
+
+    goku_config = json.load(open(args.config, 'rb'))["goku"]
+    raw_db_dir = Path(goku_config["raw_db_dir"])
+    db_config = json.load(open(raw_db_dir / "config.json", 'rb'))
+    checkpoint_file = args.checkpoint if args.checkpoint is not None else goku_config["embed_db_file"] + ".import.ckpt"
+
+    sources = collect_sources(args, goku_config["image_extensions"])
+    for field in sources:
+        if db_config["fields"].get(field, {}).get("type") != "image":
+            raise SystemExit(f"{field} is not an image field in {raw_db_dir / 'config.json'}")
+
+    # Resume: embeddings that were already computed, per field
+    checkpoint = {"embeds": {field: OrderedDict() for field in sources}, "paths": {}}
+    if os.path.exists(checkpoint_file):
+        with open(checkpoint_file, 'rb') as f:
+            checkpoint = pickle.load(f)
+        for field in sources:
+            checkpoint["embeds"].setdefault(field, OrderedDict())
+        print(f"Resuming, {sum(len(x) for x in checkpoint['embeds'].values())} embeddings in checkpoint")
+
+    # Entries goku has already, by name
+    known = {field: set(checkpoint["embeds"][field].keys()) for field in sources}
+    if os.path.exists(goku_config["embed_db_file"]):
+        with open(goku_config["embed_db_file"], 'rb') as f:
+            existing_embeds = pickle.load(f).get("embeds", {})
+        for field in sources:
+            known[field] |= set(existing_embeds.get(field, {}).keys())
+        del existing_embeds
+    for field in sources:
+        known[field] |= set(Path(x).name for x in glob_multiple(raw_db_dir / field, goku_config["image_extensions"]))
+
+    models = load_models()
+    models["clip_model"].eval()
+    pool = ProcessPoolExecutor(
+        args.workers,
+        mp_context = multiprocessing.get_context("spawn"),
+        initializer = init_preprocess_worker,
+        initargs = (models["image_preprocessor"],)
+    )
+    try:
+        # Dedupe by content hash, imported images are named by it so reruns skip them too
+        todo = []
+        for field, paths in sources.items():
+            seen = set()
+            for path, digest in pool.map(hash_file, paths, chunksize=64):
+                name = digest[:16] + Path(path).suffix.lower()
+                if name in known[field] or name in seen:
+                    continue
+                seen.add(name)
+                todo.append((field, name, path))
+        print(f"{sum(len(x) for x in sources.values())} images, {len(todo)} new after deduplication")
+
+        # Preprocess in the pool, embed in large batches in this process
+        start_time = time.time()
+        done = 0
+        batch_count = 0
+        for batch_start in range(0, len(todo), args.batch_size):
+            batch = todo[batch_start:batch_start + args.batch_size]
+            preprocessed = list(pool.map(preprocess_image, [x[2] for x in batch]))
+            batch = [entry for entry, (_, image) in zip(batch, preprocessed) if not image is None]
+            images = [image for _, image in preprocessed if not image is None]
+            if len(images) > 0:
+                with torch.no_grad():
+                    image_embeds = models["clip_model"].encode_image(torch.from_numpy(np.stack(images)))
+                    image_embeds /= image_embeds.norm(dim=-1, keepdim=True)
+                    image_embeds = image_embeds.cpu().numpy()
+                for (field, name, path), embed in zip(batch, image_embeds):
+                    checkpoint["embeds"][field][name] = embed
+                    checkpoint["paths"][name] = path
+            done += len(preprocessed)
+            batch_count += 1
+            if batch_count % args.checkpoint_every == 0:
+                store_checkpoint(checkpoint_file, checkpoint)
+                print(f"{done}/{len(todo)} images, {done / (time.time() - start_time):.1f} images/s")
+    finally:
+        pool.shutdown()
+    store_checkpoint(checkpoint_file, checkpoint)
+
+    # Import file first, then the images: goku only embeds db_raw images it has no embedding for
+    import_embeds = {field: embeds for field, embeds in checkpoint["embeds"].items() if len(embeds) > 0}
+    if len(import_embeds) > 0:
+        import_file = goku_config["embed_db_file"] + f".import.{int(time.time())}.pkl"
+        with open(import_file + ".tmp", 'wb') as f:
+            pickle.dump(import_embeds, f, protocol = pickle.HIGHEST_PROTOCOL)
+        move(import_file + ".tmp", import_file)
+        for field, embeds in import_embeds.items():
+            os.makedirs(raw_db_dir / field, exist_ok=True)
+            for name in embeds:
+                if not os.path.exists(raw_db_dir / field / name):
+                    copyfile(checkpoint["paths"][name], raw_db_dir / field / name)
+        print(f"Wrote {sum(len(x) for x in import_embeds.values())} embeddings to {import_file}")
+    os.remove(checkpoint_file)
+
+if __name__ == "__main__":
+    main()
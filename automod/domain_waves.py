@@ -0,0 +1,95 @@
+# Per-domain hit aggregation, to handle an overrun instance with one report instead of one per account
+
+import time
+from collections import deque
+
+class DomainWaveAggregator:
+    """
+    Rolling per-domain counts of checked accounts and hits, in time buckets over a sliding window.
+
+    A domain is in a wave when it has at least min_hits hits in the window and at least min_hit_ratio
+    of its checked accounts in the window were hits. Updates and checks are O(1) per account (amortized),
+    so this can run inline with the checks.
+    """
+    def __init__(self, window_seconds = 3600, bucket_seconds = 60, max_domains = 10000):
+        self.window_seconds = window_seconds
+        self.bucket_seconds = bucket_seconds
+        self.max_domains = max_domains
+        self.buckets = {} # domain -> deque of [bucket start, checked, hits]
+        self.totals = {}  # domain -> [checked, hits] over the buckets in the window
+        self.last_wave = {} # domain -> time of the last consolidated report
+
+    def __len__(self):
+        return len(self.buckets)
+
+    def _expire(self, domain, now):
+        buckets = self.buckets[domain]
+        totals = self.totals[domain]
+        while len(buckets) > 0 and buckets[0][0] <= now - self.window_seconds:
+            _, checked, hits = buckets.popleft()
+            totals[0] -= checked
+            totals[1] -= hits
+        if len(buckets) == 0:
+            del self.buckets[domain]
+            del self.totals[domain]
+
+    def observe(self, domain, hit, now = None):
+        """
+        Count one checked account for domain
+        """
+        if now is None:
+            now = time.time()
+        if not domain in self.buckets:
+            if len(self.buckets) >= self.max_domains:
+                self.prune(now)
+            self.buckets[domain] = deque()
+            self.totals[domain] = [0, 0]
+        buckets = self.buckets[domain]
+        bucket_start = now - now % self.bucket_seconds
+        if len(buckets) == 0 or buckets[-1][0] != bucket_start:
+            buckets.append([bucket_start, 0, 0])
+        buckets[-1][1] += 1
+        buckets[-1][2] += int(hit)
+        self.totals[domain][0] += 1
+        self.totals[domain][1] += int(hit)
+        self._expire(domain, now)
+
+    def prune(self, now = None):
+        """
+        Drop everything that has left the window
+        """
+        if now is None:
+            now = time.time()
+        for domain in list(self.buckets.keys()):
+            self._expire(domain, now)
+        for domain in [x for x, y in self.last_wave.items() if y <= now - self.window_seconds]:
+            del self.last_wave[domain]
+
+    def stats(self, domain, now = None):
+        """
+        (checked, hits, hits per hour) for domain over the window
+        """
+        if now is None:
+            now = time.time()
+        if not domain in self.buckets:
+            return 0, 0, 0.0
+        self._expire(domain, now)
+        if not domain in self.buckets:
+            return 0, 0, 0.0
+        checked, hits = self.totals[domain]
+        span = max(now - self.buckets[domain][0][0], self.bucket_seconds)
+        return checked, hits, hits * 3600.0 / span
+
+    def is_wave(self, domain, min_hits, min_hit_ratio, now = None):
+        checked, hits, _ = self.stats(domain, now)
+        return hits >= min_hits and hits >= min_hit_ratio * checked
+
+    def mark_wave(self, domain, now = None):
+        """
+        Remember a consolidated report went out for domain. Returns True if it is the first in the window.
+        """
+        if now is None:
+            now = time.time()
+        first = not domain in self.last_wave or self.last_wave[domain] <= now - self.window_seconds
+        self.last_wave[domain] = now
+        return first
@@ -0,0 +1,108 @@
+# Columnar recording of per-account, per-field match scores for offline threshold tuning
+
+import os
+import time
+from glob import glob
+from pathlib import Path
+
+import numpy as np
+
+class ScoreRecorder:
+    """
+    Buffers per-field best match scores (plus top-k matched db entries and wave cluster similarity / size)
+    for every checked account, and writes them out as compressed npz chunks.
+    """
+    def __init__(self, directory, topk = 3, flush_rows = 500):
+        self.directory = Path(directory)
+        self.topk = topk
+        self.flush_rows = flush_rows
+        self.rows = []
+        self.chunk_idx = 0
+        os.makedirs(self.directory, exist_ok=True)
+
+    def add(self, user_dict, field_scores, wave_size):
+        """
+        field_scores: field -> (best score, [top-k entry names], [top-k scores], cluster similarity, cluster member count)
+        wave_size: number of accounts in the cross-field cluster intersection (at the configured thresholds)
+        """
+        self.rows.append((str(user_dict["id"]), user_dict["acct"], time.time(), field_scores, wave_size))
+        if len(self.rows) >= self.flush_rows:
+            self.flush()
+
+    def flush(self):
+        if len(self.rows) == 0:
+            return
+        fields = sorted({field for row in self.rows for field in row[3]})
+        field_idx = {field: idx for idx, field in enumerate(fields)}
+        num_rows = len(self.rows)
+
+        scores = np.full((num_rows, len(fields)), np.nan, dtype=np.float32)
+        topk_scores = np.full((num_rows, len(fields), self.topk), np.nan, dtype=np.float32)
+        topk_entries = np.full((num_rows, len(fields), self.topk), "", dtype=object)
+        similar_scores = np.full((num_rows, len(fields)), np.nan, dtype=np.float32)
+        similar_counts = np.full((num_rows, len(fields)), -1, dtype=np.int32)
+        for row_idx, (_, _, _, field_scores, _) in enumerate(self.rows):
+            for field, (best, entries, entry_scores, similarity, count) in field_scores.items():
+                col = field_idx[field]
+                scores[row_idx, col] = best
+                topk_entries[row_idx, col, :len(entries)] = entries[:self.topk]
+                topk_scores[row_idx, col, :len(entry_scores)] = entry_scores[:self.topk]
+                similar_scores[row_idx, col] = similarity
+                similar_counts[row_idx, col] = count
+
+        chunk_file = self.directory / f"scores_{int(time.time())}_{os.getpid()}_{self.chunk_idx:05d}.npz"
+        np.savez_compressed(
+            chunk_file,
+            fields = np.array(fields, dtype=str),
+            account_ids = np.array([row[0] for row in self.rows], dtype=str),
+            accts = np.array([row[1] for row in self.rows], dtype=str),
+            timestamps = np.array([row[2] for row in self.rows], dtype=np.float64),
+            scores = scores,
+            topk_entries = topk_entries.astype(str),
+            topk_scores = topk_scores,
+            similar_scores = similar_scores,
+            similar_counts = similar_counts,
+            wave_sizes = np.array([row[4] for row in self.rows], dtype=np.int32),
+        )
+        self.chunk_idx += 1
+        self.rows = []
+
+def load_score_records(directory):
+    """
+    Load all chunks in a directory, aligned on the union of fields (missing values are nan / -1).
+    Accounts recorded more than once keep their latest row.
+    """
+    chunks = [np.load(x) for x in sorted(glob(str(Path(directory) / "scores_*.npz")))]
+    if len(chunks) == 0:
+        raise FileNotFoundError(f"No score records in {directory}")
+    fields = sorted({str(field) for chunk in chunks for field in chunk["fields"]})
+    field_idx = {field: idx for idx, field in enumerate(fields)}
+
+    columns = {"account_ids": [], "accts": [], "timestamps": [], "wave_sizes": [], "scores": [], "similar_scores": [], "similar_counts": [], "topk_entries": [], "topk_scores": []}
+    for chunk in chunks:
+        num_rows = chunk["scores"].shape[0]
+        topk = chunk["topk_scores"].shape[2]
+        cols = [field_idx[str(field)] for field in chunk["fields"]]
+        scores = np.full((num_rows, len(fields)), np.nan, dtype=np.float32)
+        similar_scores = np.full((num_rows, len(fields)), np.nan, dtype=np.float32)
+        similar_counts = np.full((num_rows, len(fields)), -1, dtype=np.int32)
+        topk_entries = np.full((num_rows, len(fields), topk), "", dtype=chunk["topk_entries"].dtype)
+        topk_scores = np.full((num_rows, len(fields), topk), np.nan, dtype=np.float32)
+        scores[:, cols] = chunk["scores"]
+        similar_scores[:, cols] = chunk["similar_scores"]
+        similar_counts[:, cols] = chunk["similar_counts"]
+        topk_entries[:, cols] = chunk["topk_entries"]
+        topk_scores[:, cols] = chunk["topk_scores"]
+        for key, value in (("account_ids", chunk["account_ids"]), ("accts", chunk["accts"]), ("timestamps", chunk["timestamps"]), ("wave_sizes", chunk["wave_sizes"]), ("scores", scores),
+                           ("similar_scores", similar_scores), ("similar_counts", similar_counts), ("topk_entries", topk_entries), ("topk_scores", topk_scores)):
+            columns[key].append(value)
+
+    records = {key: np.concatenate(value) for key, value in columns.items()}
+
+    # Keep only the latest row per account
+    order = np.argsort(records["timestamps"], kind="stable")[::-1]
+    _, first_idx = np.unique(records["account_ids"][order], return_index=True)
+    keep = np.sort(order[first_idx])
+    records = {key: value[keep] for key, value in records.items()}
+    records["fields"] = fields
+    return records
@@ -0,0 +1,144 @@
+# Offline threshold sweep over recorded score matrices
+#
+# Usage (from the repository root):
+#   python -m automod.tune_thresholds --records automod/score_records --outcomes outcomes.csv --output sweep.csv
+#
+# Outcomes are either a csv with account_id,is_spam rows or a json object {account_id: true/false},
+# e.g. exported from resolved reports (true = moderator confirmed, false = false positive).
+
+import csv
+import json
+import argparse
+from pathlib import Path
+
+import numpy as np
+
+from automod.score_recording import load_score_records
+
+def load_outcomes(path):
+    """
+    account id (str) -> bool
+    """
+    if str(path).endswith(".json"):
+        return {str(k): bool(v) for k, v in json.load(open(path, 'rb')).items()}
+    outcomes = {}
+    with open(path, newline='') as f:
+        for row in csv.reader(f):
+            if len(row) < 2 or row[0] == "account_id":
+                continue
+            outcomes[str(row[0])] = row[1].strip().lower() in ("1", "true", "yes", "spam")
+    return outcomes
+
+def sweep_thresholds(records, config, labels, labelled, threshold_offsets, similar_offsets, likelihood_thresholds, flag_thresholds):
+    """
+    Evaluate every combination of
+     * an offset applied to all per-field "threshold" values
+     * an offset applied to all per-field "threshold_similar" values
+     * overall_threshold_likelihood
+     * overall_threshold_flags
+    over all recorded accounts at once. Returns a structured array with precision, recall and report counts.
+
+    The similarity part is an approximation: it uses each accounts closest wave cluster at recording time
+    (similarity and member count) instead of re-clustering, and the size of the cross-field intersection
+    as it was at the configured thresholds.
+    """
+    fields = records["fields"]
+    scores = records["scores"]
+    similar_scores = records["similar_scores"]
+    similar_counts = records["similar_counts"]
+    field_thresholds = np.array([config["fields"].get(x, {}).get("threshold", np.inf) for x in fields], dtype=np.float32)
+    field_thresholds_similar = np.array([config["fields"].get(x, {}).get("threshold_similar", np.inf) for x in fields], dtype=np.float32)
+
+    # (offsets, accounts): number of fields over threshold, nan compares false so missing fields never count
+    with np.errstate(invalid="ignore"):
+        flag_counts = (scores[None, :, :] >= (field_thresholds[None, None, :] + threshold_offsets[:, None, None])).sum(axis=2)
+        best_scores = np.nan_to_num(np.max(np.where(np.isnan(scores), -np.inf, scores), axis=1), neginf=0.0)
+        similar_flags = ((similar_scores[None, :, :] >= (field_thresholds_similar[None, None, :] + similar_offsets[:, None, None])) &
+                         (similar_counts[None, :, :] >= config["similar_users_count_threshold"])).sum(axis=2)
+    wave_hits = (similar_flags >= config["similar_users_threshold_flags"]) & (records["wave_sizes"][None, :] >= config["similar_users_count_threshold"])   # (similar offsets, accounts)
+    likelihood_hits = best_scores[None, :] >= likelihood_thresholds[:, None]  # (likelihood thresholds, accounts)
+    flag_hits = flag_counts[:, None, :] >= flag_thresholds[None, :, None]     # (offsets, flag thresholds, accounts)
+
+    spam = labels & labelled
+    ham = ~labels & labelled
+    positives = np.sum(spam)
+    grid = np.array(np.meshgrid(similar_offsets, likelihood_thresholds, flag_thresholds, indexing="ij")).reshape(3, -1)
+    results = np.zeros(len(threshold_offsets) * grid.shape[1], dtype=[
+        ("threshold_offset", "f4"), ("threshold_similar_offset", "f4"), ("overall_threshold_likelihood", "f4"), ("overall_threshold_flags", "i4"),
+        ("tp", "i8"), ("fp", "i8"), ("fn", "i8"), ("hits", "i8")
+    ])
+    for offset_idx, threshold_offset in enumerate(threshold_offsets):
+        # (similar offsets, likelihood thresholds, flag thresholds, accounts), flattened in meshgrid order
+        match_hits = likelihood_hits[:, None, :] | flag_hits[offset_idx][None, :, :]
+        hits = (match_hits[None, :, :, :] | wave_hits[:, None, None, :]).reshape(-1, len(labels))
+        rows = slice(offset_idx * grid.shape[1], (offset_idx + 1) * grid.shape[1])
+        results["threshold_offset"][rows] = threshold_offset
+        results["threshold_similar_offset"][rows] = grid[0]
+        results["overall_threshold_likelihood"][rows] = grid[1]
+        results["overall_threshold_flags"][rows] = grid[2]
+        results["tp"][rows] = np.count_nonzero(hits & spam[None, :], axis=1)
+        results["fp"][rows] = np.count_nonzero(hits & ham[None, :], axis=1)
+        results["hits"][rows] = np.count_nonzero(hits, axis=1)
+    results["fn"] = positives - results["tp"]
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Sweep Goku thresholds over recorded scores")
+    parser.add_argument("--records", required=True, help="score_record_dir of goku")
+    parser.add_argument("--outcomes", required=True, help="csv (account_id,is_spam) or json {account_id: bool}")
+    parser.add_argument("--config", default=str(Path(__file__).parent / "db_raw" / "config.json"), help="classifier config the offsets apply to")
+    parser.add_argument("--threshold-offsets", default="-0.10:0.05:0.01")
+    parser.add_argument("--similar-offsets", default="-0.05:0.03:0.01")
+    parser.add_argument("--likelihood-thresholds", default="0.85:1.0:0.01")
+    parser.add_argument("--flag-thresholds", default="1:4:1")
+    parser.add_argument("--min-recall", type=float, default=0.0)
+    parser.add_argument("--max-reports-per-day", type=float, default=None)
+    parser.add_argument("--output", default=None, help="csv file for the full sweep")
+    parser.add_argument("--top", type=int, default=20)
+    args = parser.parse_args()
+
+    def parse_range(value):
+        start, stop, step = [float(x) for x in value.split(":")]
+        return np.arange(start, stop + step / 2.0, step, dtype=np.float32)
+
+    records = load_score_records(args.records)
+    config = json.load(open(args.config, 'rb'))
+    outcomes = load_outcomes(args.outcomes)
+    labelled = np.array([x in outcomes for x in records["account_ids"]])
+    labels = np.array([outcomes.get(x, False) for x in records["account_ids"]])
+    if not np.any(labelled):
+        raise SystemExit("None of the outcome account ids appear in the records")
+
+    results = sweep_thresholds(
+        records, config, labels, labelled,
+        parse_range(args.threshold_offsets), parse_range(args.similar_offsets),
+        parse_range(args.likelihood_thresholds), parse_range(args.flag_thresholds).astype(np.int32)
+    )
+
+    # Report volume estimate: hits over all recorded accounts, scaled to the recording period
+    span_days = max((records["timestamps"].max() - records["timestamps"].min()) / 86400.0, 1.0 / 24.0)
+    precision = np.divide(results["tp"], results["tp"] + results["fp"], out=np.zeros(len(results), dtype=np.float32), where=(results["tp"] + results["fp"]) > 0)
+    recall = np.divide(results["tp"], results["tp"] + results["fn"], out=np.zeros(len(results), dtype=np.float32), where=(results["tp"] + results["fn"]) > 0)
+    f1 = np.divide(2 * precision * recall, precision + recall, out=np.zeros(len(results), dtype=np.float32), where=(precision + recall) > 0)
+    reports_per_day = results["hits"] / span_days
+
+    print(f"{len(records['account_ids'])} recorded accounts over {span_days:.2f} days, {int(labelled.sum())} with outcomes ({int((labels & labelled).sum())} spam), {len(results)} combinations")
+    if args.output is not None:
+        with open(args.output, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(list(results.dtype.names) + ["precision", "recall", "f1", "reports_per_day"])
+            for row, row_precision, row_recall, row_f1, row_reports in zip(results, precision, recall, f1, reports_per_day):
+                writer.writerow(list(row) + [row_precision, row_recall, row_f1, row_reports])
+
+    candidates = recall >= args.min_recall
+    if args.max_reports_per_day is not None:
+        candidates &= reports_per_day <= args.max_reports_per_day
+    order = [x for x in np.lexsort((-precision, -f1)) if candidates[x]][:args.top]
+    print(f"{'thr+':>6} {'sim+':>6} {'lik':>6} {'flags':>5} {'prec':>6} {'recall':>6} {'f1':>6} {'reports/day':>12}")
+    for idx in order:
+        row = results[idx]
+        print(f"{row['threshold_offset']:>6.2f} {row['threshold_similar_offset']:>6.2f} {row['overall_threshold_likelihood']:>6.2f} {row['overall_threshold_flags']:>5} "
+              f"{precision[idx]:>6.3f} {recall[idx]:>6.3f} {f1[idx]:>6.3f} {reports_per_day[idx]:>12.1f}")
+
+if __name__ == "__main__":
+    main()
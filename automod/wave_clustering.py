@@ -0,0 +1,95 @@
+# Streaming leader clustering for spam wave detection
+
+import numpy as np
+
+class WaveClusterer:
+    """
+    Online leader / centroid clustering over the embeddings of one field.
+
+    Every new embedding either joins the most similar cluster (if the centroid is at least threshold similar)
+    or starts a new one. Cluster count and per-cluster member lists are capped (least recently hit clusters
+    and oldest members are dropped first), so the cost per account does not grow with history.
+    Each cluster also remembers the report filed for it, so a wave is only reported once.
+    """
+    def __init__(self, max_clusters = 1000, max_members = 100):
+        self.max_clusters = max_clusters
+        self.max_members = max_members
+        self.centroids = None
+        self.sizes = np.zeros(0, dtype=np.int64)
+        self.last_hit = np.zeros(0, dtype=np.int64)
+        self.members = []
+        self.report_ids = []
+        self.step = 0
+
+    def __len__(self):
+        return len(self.members)
+
+    def _new_cluster(self, embed):
+        if self.centroids is None:
+            self.centroids = np.zeros((min(16, self.max_clusters), embed.shape[0]), dtype=np.float32)
+            self.sizes = np.zeros(self.centroids.shape[0], dtype=np.int64)
+            self.last_hit = np.zeros(self.centroids.shape[0], dtype=np.int64)
+
+        if len(self.members) < self.max_clusters:
+            # Grow storage by doubling
+            cluster_idx = len(self.members)
+            if cluster_idx >= self.centroids.shape[0]:
+                new_capacity = min(self.centroids.shape[0] * 2, self.max_clusters)
+                self.centroids = np.vstack([self.centroids, np.zeros((new_capacity - self.centroids.shape[0], self.centroids.shape[1]), dtype=np.float32)])
+                self.sizes = np.concatenate([self.sizes, np.zeros(new_capacity - self.sizes.shape[0], dtype=np.int64)])
+                self.last_hit = np.concatenate([self.last_hit, np.zeros(new_capacity - self.last_hit.shape[0], dtype=np.int64)])
+            self.members.append([])
+            self.report_ids.append(None)
+        else:
+            # Full: recycle the least recently hit cluster
+            cluster_idx = int(np.argmin(self.last_hit[:len(self.members)]))
+            self.members[cluster_idx] = []
+            self.report_ids[cluster_idx] = None
+
+        self.centroids[cluster_idx] = embed
+        self.sizes[cluster_idx] = 0
+        return cluster_idx
+
+    def match(self, embed):
+        """
+        Find the most similar cluster. Returns (cluster index, similarity), or (None, 0.0) if there are no clusters.
+        """
+        if len(self.members) == 0:
+            return None, 0.0
+        similarities = self.centroids[:len(self.members)] @ embed
+        cluster_idx = int(np.argmax(similarities))
+        return cluster_idx, float(similarities[cluster_idx])
+
+    def add(self, embed, member, threshold):
+        """
+        Assign an embedding to a cluster, creating a new one if nothing is similar enough.
+        Returns (cluster index, similarity to the matched centroid, or 1.0 for a new cluster).
+        """
+        self.step += 1
+        cluster_idx, similarity = self.match(embed)
+        if cluster_idx is None or similarity < threshold:
+            cluster_idx = self._new_cluster(embed)
+            similarity = 1.0
+        else:
+            # Running mean, renormalized so centroids stay comparable with cosine similarity
+            centroid = self.centroids[cluster_idx] * self.sizes[cluster_idx] + embed
+            self.centroids[cluster_idx] = centroid / max(np.linalg.norm(centroid), 1e-12)
+
+        self.sizes[cluster_idx] += 1
+        self.last_hit[cluster_idx] = self.step
+        cluster_members = self.members[cluster_idx]
+        cluster_members.append(member)
+        if len(cluster_members) > self.max_members:
+            del cluster_members[:len(cluster_members) - self.max_members]
+        return cluster_idx, similarity
+
+    def get_members(self, cluster_idx):
+        if cluster_idx is None:
+            return []
+        return self.members[cluster_idx]
+
+    def get_report_id(self, cluster_idx):
+        return self.report_ids[cluster_idx]
+
+    def set_report_id(self, cluster_idx, report_id):
+        self.report_ids[cluster_idx] = report_id
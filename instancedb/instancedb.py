@@ -4,25 +4,60 @@ import time
 import threading
 import os
 import pickle as pkl
+from concurrent.futures import ThreadPoolExecutor, wait
 from mastodon import Mastodon
 
+class NodeinfoSnapshot:
+    """
+    Nodeinfo for a fixed set of instances, as prefetched by Piccolo. Offers the same lookups as Piccolo,
+    but never goes to the network: instances that are not in the snapshot fall back to whatever the
+    cache has (even if stale), or no info.
+    """
+    def __init__(self, nodeinfo, state = None):
+        self.nodeinfo = nodeinfo
+        self.state = state
+
+    def get_nodeinfo(self, instance_url):
+        instance_url = Piccolo.normalize_instance_url(instance_url)
+        if instance_url in self.nodeinfo:
+            instance_last_update, instance_info = self.nodeinfo[instance_url]
+        elif self.state is not None:
+            instance_last_update, instance_info = self.state.kv_get("piccolo", instance_url, (-1, None))
+        else:
+            instance_last_update, instance_info = (-1, None)
+        return (instance_url, instance_last_update, instance_info)
+
+    def is_closed_regs_instance(self, instance_url):
+        is_closed = False
+        try:
+            is_closed = self.get_nodeinfo(instance_url)[2]["openRegistrations"] == False
+        except:
+            pass
+        return is_closed
+
 class Piccolo:
     """
     It's Piccolo, the Platform for Instance Cataloging (with Cache Of Last Operations)
     """
     def __init__(self, component_manager, max_cache_age_seconds = 43200):
         self.max_cache_age_seconds = max_cache_age_seconds
-        self.instance_cache = {}
         self.component_manager = component_manager
         self.last_store = time.time()
         self.store_lock = threading.Lock()
         self.store_interval = 60
 
+        # Instance cache lives in the state backend (namespace "piccolo"), so replicas share it.
+        # The pickle file is only written for non-persistent backends, but always read to seed the cache.
         cache_file = component_manager.get_component("settings").get_config("piccolo")["cache_file"]
         if os.path.exists(cache_file):
-            self.instance_cache = pkl.load(open(cache_file, 'rb'))
+            state = self.component_manager.get_component("state")
+            for instance_url, cache_entry in pkl.load(open(cache_file, 'rb')).items():
+                if state.kv_get("piccolo", instance_url) is None:
+                    state.kv_set("piccolo", instance_url, cache_entry)
+        self.component_manager.get_component("metrics").register_gauge("piccolo_instance_cache_size", lambda: self.component_manager.get_component("state").kv_size("piccolo"))
 
-    def normalize_instance_url(self, instance_url):
+    @staticmethod
+    def normalize_instance_url(instance_url):
         """
         Trim protocols
 
@@ -34,32 +69,38 @@ class Piccolo:
             instance_url = instance_url[8:]
         return instance_url
 
-    def update_nodeinfo(self, instance_url):
+    def update_nodeinfo(self, instance_url, timeout = 300):
         """
         Try to find nodeinfo and update cache
         """
         instance_url = self.normalize_instance_url(instance_url)
         self.component_manager.get_component("logging").add_log("Piccolo", "Info", f"Fetching nodeinfo for {instance_url}")
         instance_info = None
-        try:
-            instance_info = Mastodon(api_base_url = f"https://{instance_url}", version_check_mode="none").instance_nodeinfo()
-        except:
-            pass
-        if instance_info is None:
+        with self.component_manager.get_component("metrics").timer("piccolo_stage_seconds", stage="fetch_nodeinfo"):
             try:
-                instance_info = Mastodon(api_base_url = f"http://{instance_url}", version_check_mode="none").instance_nodeinfo()
+                instance_info = Mastodon(api_base_url = f"https://{instance_url}", version_check_mode="none", request_timeout = timeout).instance_nodeinfo()
             except:
                 pass
+            if instance_info is None:
+                try:
+                    instance_info = Mastodon(api_base_url = f"http://{instance_url}", version_check_mode="none", request_timeout = timeout).instance_nodeinfo()
+                except:
+                    pass
+        if instance_info is None:
+            self.component_manager.get_component("metrics").inc("piccolo_fetch_failures_total")
+        state = self.component_manager.get_component("state")
         if not instance_info is None:
-            self.instance_cache[instance_url] = (time.time(), instance_info)
+            state.kv_set("piccolo", instance_url, (time.time(), instance_info))
 
             # Possibly write to file
-            if self.store_lock.acquire(blocking=False):
+            if not state.persistent and self.store_lock.acquire(blocking=False):
                 try:
                     if time.time() - self.last_store > self.store_interval:
                         cache_file = self.component_manager.get_component("settings").get_config("piccolo")["cache_file"]
-                        with open(cache_file, 'wb') as f:
-                            pkl.dump(self.instance_cache, f)
+                        with self.component_manager.get_component("metrics").timer("piccolo_stage_seconds", stage="pickling"):
+                            instance_cache = {x: state.kv_get("piccolo", x) for x in state.kv_keys("piccolo")}
+                            with open(cache_file, 'wb') as f:
+                                pkl.dump(instance_cache, f)
                         self.last_store = time.time()
                         self.component_manager.get_component("logging").add_log("Piccolo", "Info", f"Stored instance db cache")
                 except Exception as e:
@@ -67,8 +108,9 @@ class Piccolo:
                 finally:
                     self.store_lock.release()
 
-        if instance_url in self.instance_cache:
-            return self.instance_cache[instance_url]
+        cache_entry = state.kv_get("piccolo", instance_url)
+        if cache_entry is not None:
+            return cache_entry
         else:
             self.component_manager.get_component("logging").add_log("Piccolo", "Warning", f"Retrieving info failed for {instance_url}")
             return (-1, None)
@@ -77,21 +119,54 @@ class Piccolo:
         """
         Find instances from the cache
         """
-        return [k for k in self.instance_cache if name in k]
+        return [k for k in self.component_manager.get_component("state").kv_keys("piccolo") if name in k]
 
     def get_nodeinfo(self, instance_url):
         """
         Get nodeinfo, update if needed
         """
         instance_url = self.normalize_instance_url(instance_url)
-        instance_last_update = -1
-        instance_info = None
-        if instance_url in self.instance_cache:
-            instance_last_update, instance_info = self.instance_cache[instance_url]
+        instance_last_update, instance_info = self.component_manager.get_component("state").kv_get("piccolo", instance_url, (-1, None))
         if time.time() - instance_last_update > self.max_cache_age_seconds:
+            self.component_manager.get_component("metrics").inc("piccolo_cache_misses_total")
             instance_last_update, instance_info = self.update_nodeinfo(instance_url)
+        else:
+            self.component_manager.get_component("metrics").inc("piccolo_cache_hits_total")
         return (instance_url, instance_last_update, instance_info)
     
+    def prefetch_nodeinfo(self, instance_urls, max_workers = 16, timeout = 10):
+        """
+        Get nodeinfo for many instances at once: deduplicate, fetch whatever is missing or stale concurrently
+        and return a NodeinfoSnapshot. Fetches that take longer than timeout are left out of the snapshot
+        (they still finish in the background and land in the cache).
+        """
+        state = self.component_manager.get_component("state")
+        snapshot = {}
+        stale_urls = []
+        for instance_url in set(self.normalize_instance_url(x) for x in instance_urls):
+            cache_entry = state.kv_get("piccolo", instance_url)
+            if cache_entry is not None and time.time() - cache_entry[0] <= self.max_cache_age_seconds:
+                snapshot[instance_url] = cache_entry
+            else:
+                stale_urls.append(instance_url)
+        self.component_manager.get_component("metrics").inc("piccolo_cache_hits_total", len(snapshot))
+        self.component_manager.get_component("metrics").inc("piccolo_cache_misses_total", len(stale_urls))
+
+        if len(stale_urls) > 0:
+            with self.component_manager.get_component("metrics").timer("piccolo_stage_seconds", stage="prefetch_nodeinfo"):
+                pool = ThreadPoolExecutor(min(max_workers, len(stale_urls)))
+                futures = {pool.submit(self.update_nodeinfo, x, timeout): x for x in stale_urls}
+                done, not_done = wait(futures, timeout = timeout)
+                pool.shutdown(wait = False)
+            for future in done:
+                cache_entry = future.result()
+                if cache_entry[1] is not None:
+                    snapshot[futures[future]] = cache_entry
+            if len(not_done) > 0:
+                self.component_manager.get_component("metrics").inc("piccolo_prefetch_timeouts_total", len(not_done))
+                self.component_manager.get_component("logging").add_log("Piccolo", "Info", f"Nodeinfo prefetch timed out for {len(not_done)} of {len(stale_urls)} instances")
+        return NodeinfoSnapshot(snapshot, state)
+
     def is_closed_regs_instance(self, instance_url):
         """
         Determine if an instance for-sure reports that registrations are closed
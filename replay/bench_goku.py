@@ -0,0 +1,299 @@
+# End-to-end Goku benchmark on replayed / synthetic fixtures
+#
+# Usage (from the repository root):
+#   python -m replay.bench_goku synthesize fixtures/synth --accounts 2000
+#   python -m replay.bench_goku record fixtures/live --instance https://example.social --token TOKEN
+#   python -m replay.bench_goku run fixtures/synth --output bench_results/$(git rev-parse --short HEAD).json
+#   python -m replay.bench_goku run fixtures/synth --events --output bench_results/events.json
+#   python -m replay.bench_goku send-events fixtures/synth --app-url http://127.0.0.1:5000/ --secret WEBHOOK_SECRET
+#   python -m replay.bench_goku compare bench_results/old.json bench_results/new.json
+
+import os
+import sys
+import json
+import time
+import pickle
+import argparse
+import tempfile
+import resource
+import subprocess
+from pathlib import Path
+
+import numpy as np
+
+from replay.replay import FakeMastodon, MediaServer, record_fixture, synthesize_fixture, send_account_events
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on linux, bytes on mac
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return peak / (1024 * 1024)
+    return peak / 1024
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=REPO_ROOT, stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+def write_bench_config(workdir, raw_db_dir, nodeinfo):
+    """
+    Write a global config (and a prefilled piccolo cache so nothing goes out to the network) into workdir
+    """
+    workdir = Path(workdir)
+    piccolo_cache = workdir / "piccolo_cache.pkl"
+    instance_cache = {domain: (time.time(), info if info is not None else {}) for domain, info in nodeinfo.items()}
+    with open(piccolo_cache, 'wb') as f:
+        pickle.dump(instance_cache, f)
+
+    config = {
+        "base": {
+            "app_base_url": "http://127.0.0.1/",
+            "app_session_secret": "bench",
+            "connected_instance": "http://127.0.0.1/",
+            "client_cred_file": str(workdir / "clientcred.secret"),
+            "i_promise_to_be_really_careful": True
+        },
+        "goku": {
+            "raw_db_dir": str(raw_db_dir),
+            "embed_db_file": str(workdir / "db.pkl"),
+            "image_extensions": ["gif", "png", "jpg", "jpeg"],
+            "wait_time": 0,
+            "status_retry_wait": 0.0,
+            "preemptive_silence": True,
+            "panic_stop": 1000000000,
+            "max_fetch_pages": 1000000,
+            "id_hist_length": 1000000,
+            "preemptive_suspend_thresh": 0.99,
+            "webhook_secret": "bench"
+        },
+        "piccolo": {
+            "cache_file": str(piccolo_cache)
+        }
+    }
+    config_file = workdir / "global_config.json"
+    with open(config_file, 'w') as f:
+        json.dump(config, f, indent=4)
+    return config_file
+
+def instrument_goku(goku):
+    """
+    Count CLIP calls and time every per-user check. Returns the dict the counters are collected in.
+    """
+    stats = {"clip_image_calls": 0, "clip_image_items": 0, "clip_text_calls": 0, "clip_text_items": 0, "user_latencies": []}
+    clip_model = goku.models["clip_model"]
+    encode_image = clip_model.encode_image
+    encode_text = clip_model.encode_text
+
+    def counting_encode_image(images, *args, **kwargs):
+        stats["clip_image_calls"] += 1
+        stats["clip_image_items"] += len(images)
+        return encode_image(images, *args, **kwargs)
+
+    def counting_encode_text(texts, *args, **kwargs):
+        stats["clip_text_calls"] += 1
+        stats["clip_text_items"] += len(texts)
+        return encode_text(texts, *args, **kwargs)
+
+    clip_model.encode_image = counting_encode_image
+    clip_model.encode_text = counting_encode_text
+
+    check_user = goku.check_user
+    def timed_check_user(user, *args, **kwargs):
+        start = time.perf_counter()
+        result = check_user(user, *args, **kwargs)
+        stats["user_latencies"].append(time.perf_counter() - start)
+        return result
+    goku.check_user = timed_check_user
+    return stats
+
+def run_benchmark(fixture, raw_db_dir, release_batch = 50, page_size = 100, api_latency = 0.0, workdir = None, events = False):
+    """
+    Run Goku end to end against a fixture and return a result dict.
+    With events, released accounts are pushed through the account queue instead of being found by polling,
+    and a single fallback poll runs at the end.
+    """
+    from app_utils import ComponentManager, Logging, SettingsManager, Metrics
+    from app_state import MemoryStateBackend
+    from instancedb.instancedb import Piccolo
+    from automod.automod import Goku
+
+    fixture = Path(fixture)
+    nodeinfo = {}
+    if (fixture / "nodeinfo.json").exists():
+        nodeinfo = json.load(open(fixture / "nodeinfo.json", 'rb'))
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        workdir = Path(workdir or tempdir)
+        os.makedirs(workdir, exist_ok=True)
+        config_file = write_bench_config(workdir, raw_db_dir, nodeinfo)
+
+        media_server = MediaServer(fixture).start()
+        try:
+            fake_mastodon = FakeMastodon(fixture, media_server.base_url, page_size = page_size, api_latency = api_latency)
+
+            component_manager = ComponentManager()
+            component_manager.register_component("logging", Logging())
+            component_manager.register_component("metrics", Metrics())
+            component_manager.register_component("settings", SettingsManager(str(config_file), component_manager))
+            component_manager.register_component("state", MemoryStateBackend())
+            component_manager.register_component("piccolo", Piccolo(component_manager))
+            component_manager.register_component("mastodon", fake_mastodon)
+
+            model_load_start = time.perf_counter()
+            goku = Goku(component_manager)
+            component_manager.register_component("goku", goku, True)
+            model_load_time = time.perf_counter() - model_load_start
+            rss_after_load = peak_rss_mb()
+
+            # Embed the db before we start timing
+            db_build_start = time.perf_counter()
+            goku.update_db()
+            db_build_time = time.perf_counter() - db_build_start
+
+            # Only keep metrics from the timed part of the run
+            stats = instrument_goku(goku)
+            component_manager.get_component("metrics").reset()
+            checked = 0
+            cycles = 0
+            run_start = time.perf_counter()
+            while not fake_mastodon.all_released() and not goku._stop_request.is_set():
+                released = fake_mastodon.release(release_batch)
+                if events:
+                    for account in released:
+                        goku.enqueue_account(account.id)
+                    checked += goku.process_account_queue()
+                else:
+                    checked += goku.check_cycle()
+                cycles += 1
+            if events:
+                checked += goku.check_cycle()
+            run_time = time.perf_counter() - run_start
+        finally:
+            media_server.stop()
+
+    latencies = np.array(stats["user_latencies"]) * 1000.0
+    if len(latencies) == 0:
+        latencies = np.zeros(1)
+    return {
+        "commit": git_commit(),
+        "timestamp": time.time(),
+        "fixture": str(fixture),
+        "params": {"release_batch": release_batch, "page_size": page_size, "api_latency": api_latency, "events": events},
+        "accounts": checked,
+        "cycles": cycles,
+        "run_time_s": run_time,
+        "accounts_per_sec": checked / run_time if run_time > 0 else 0.0,
+        "latency_ms": {
+            "p50": float(np.percentile(latencies, 50)),
+            "p99": float(np.percentile(latencies, 99)),
+            "mean": float(np.mean(latencies)),
+            "max": float(np.max(latencies)),
+        },
+        "model_load_s": model_load_time,
+        "db_build_s": db_build_time,
+        "rss_after_model_load_mb": rss_after_load,
+        "peak_rss_mb": peak_rss_mb(),
+        "clip_calls": {
+            "image_calls": stats["clip_image_calls"],
+            "image_items": stats["clip_image_items"],
+            "text_calls": stats["clip_text_calls"],
+            "text_items": stats["clip_text_items"],
+        },
+        "api_calls": fake_mastodon.api_calls,
+        "reports": len(fake_mastodon.reports),
+        "moderation_actions": len(fake_mastodon.moderation_actions),
+        "domain_blocks": len(fake_mastodon.domain_blocks),
+        "stages": {timing["name"]: {k: v for k, v in timing.items() if k != "name"} for timing in component_manager.get_component("metrics").summary()["timings"]},
+    }
+
+def flatten(result, prefix = ""):
+    flat = {}
+    for key, value in result.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, prefix + key + "."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[prefix + key] = value
+    return flat
+
+def compare_results(old_file, new_file):
+    """
+    Print numeric metrics of two result files side by side
+    """
+    old = flatten(json.load(open(old_file, 'rb')))
+    new = flatten(json.load(open(new_file, 'rb')))
+    print(f"{'metric':<32} {'old':>14} {'new':>14} {'change':>9}")
+    for key in sorted(old.keys() & new.keys()):
+        if key in ("timestamp",):
+            continue
+        change = ""
+        if old[key] != 0:
+            change = f"{(new[key] - old[key]) / abs(old[key]) * 100.0:+.1f}%"
+        print(f"{key:<32} {old[key]:>14.3f} {new[key]:>14.3f} {change:>9}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline replay benchmark for Goku")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    synth_parser = subparsers.add_parser("synthesize", help="generate a synthetic fixture")
+    synth_parser.add_argument("fixture")
+    synth_parser.add_argument("--raw-db-dir", default=str(REPO_ROOT / "automod" / "db_raw"))
+    synth_parser.add_argument("--accounts", type=int, default=1000)
+    synth_parser.add_argument("--spam-fraction", type=float, default=0.05)
+    synth_parser.add_argument("--domains", type=int, default=50)
+    synth_parser.add_argument("--seed", type=int, default=0)
+
+    record_parser = subparsers.add_parser("record", help="record a fixture from a live instance")
+    record_parser.add_argument("fixture")
+    record_parser.add_argument("--instance", required=True)
+    record_parser.add_argument("--token", required=True, help="admin access token with admin:read and read scopes")
+    record_parser.add_argument("--pages", type=int, default=10)
+    record_parser.add_argument("--no-media", action="store_true")
+
+    run_parser = subparsers.add_parser("run", help="run goku end to end against a fixture")
+    run_parser.add_argument("fixture")
+    run_parser.add_argument("--raw-db-dir", default=str(REPO_ROOT / "automod" / "db_raw"))
+    run_parser.add_argument("--release-batch", type=int, default=50, help="accounts that become visible per cycle")
+    run_parser.add_argument("--page-size", type=int, default=100)
+    run_parser.add_argument("--api-latency", type=float, default=0.0, help="simulated seconds per api call")
+    run_parser.add_argument("--workdir", default=None)
+    run_parser.add_argument("--events", action="store_true", help="feed accounts through the event queue instead of polling")
+    run_parser.add_argument("--output", default=None, help="json file to store results in")
+
+    events_parser = subparsers.add_parser("send-events", help="post signed account.created webhooks for a recorded fixture to a running app (ids must exist on the connected instance)")
+    events_parser.add_argument("fixture")
+    events_parser.add_argument("--app-url", required=True)
+    events_parser.add_argument("--secret", required=True, help="goku webhook_secret of the app")
+    events_parser.add_argument("--interval", type=float, default=0.0, help="seconds between events")
+
+    compare_parser = subparsers.add_parser("compare", help="compare two result files")
+    compare_parser.add_argument("old")
+    compare_parser.add_argument("new")
+
+    args = parser.parse_args()
+    if args.command == "synthesize":
+        count = synthesize_fixture(args.fixture, args.raw_db_dir, args.accounts, args.spam_fraction, args.domains, args.seed)
+        print(f"Synthesized {count} accounts into {args.fixture}")
+    elif args.command == "record":
+        from mastodon import Mastodon
+        mastodon = Mastodon(api_base_url = args.instance, access_token = args.token)
+        count = record_fixture(mastodon, args.fixture, max_pages = args.pages, download_media = not args.no_media)
+        print(f"Recorded {count} accounts into {args.fixture}")
+    elif args.command == "run":
+        result = run_benchmark(args.fixture, args.raw_db_dir, args.release_batch, args.page_size, args.api_latency, args.workdir, args.events)
+        print(json.dumps(result, indent=4))
+        if args.output is not None:
+            os.makedirs(Path(args.output).parent, exist_ok=True)
+            with open(args.output, 'w') as f:
+                json.dump(result, f, indent=4)
+    elif args.command == "send-events":
+        account_ids = [account["id"] for account in json.load(open(Path(args.fixture) / "accounts.json", 'rb'))]
+        sent = send_account_events(args.app_url, args.secret, account_ids, interval = args.interval)
+        print(f"Sent {sent} / {len(account_ids)} events")
+    elif args.command == "compare":
+        compare_results(args.old, args.new)
+
+if __name__ == "__main__":
+    main()
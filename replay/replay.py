@@ -0,0 +1,342 @@
+# Offline replay tooling: record / synthesize fixtures and serve them to Goku
+
+import os
+import json
+import time
+import random
+import shutil
+import hashlib
+import hmac
+import threading
+import functools
+from pathlib import Path
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+import requests
+from mastodon import MastodonNotFoundError
+
+# Placeholder for the media server address in fixture files, replaced on load
+MEDIA_BASE_PLACEHOLDER = "{media_base}"
+
+class AttribAccessDict(dict):
+    """
+    Minimal stand-in for the mastodon.py result dicts (dict with attribute access)
+    """
+    def __getattr__(self, attr):
+        if attr in self:
+            return self[attr]
+        raise AttributeError(f"Attribute not found: {attr}")
+
+    def __setattr__(self, attr, value):
+        self[attr] = value
+
+def to_attrib_dict(value):
+    """
+    Recursively convert plain json values into AttribAccessDicts
+    """
+    if isinstance(value, dict):
+        return AttribAccessDict({k: to_attrib_dict(v) for k, v in value.items()})
+    if isinstance(value, list):
+        return [to_attrib_dict(x) for x in value]
+    return value
+
+class FakePage(list):
+    """
+    A page of results, remembers where it is so fetch_next can find the next one
+    """
+    def __init__(self, items, page_index):
+        super().__init__(items)
+        self.page_index = page_index
+
+class FakeMastodon:
+    """
+    Serves a fixture directory through the subset of the mastodon.py API that the components use.
+    Accounts become visible in arrival order via release(), newest first like the real admin API.
+    Moderation calls are recorded instead of executed.
+    """
+    def __init__(self, fixture, media_base, page_size = 100, api_latency = 0.0):
+        self.fixture = fixture
+        self.media_base = media_base
+        self.page_size = page_size
+        self.api_latency = api_latency
+        self.released = 0
+        self.api_calls = 0
+        self.reports = []
+        self.moderation_actions = []
+        self.domain_blocks = []
+        self.lock = threading.Lock()
+
+        fixture = Path(fixture)
+        self.accounts = self._load_json(fixture / "accounts.json")
+        self.accounts_by_id = {account.id: account for account in self.accounts}
+        self.statuses = self._load_json(fixture / "statuses.json")
+
+    def _load_json(self, path):
+        with open(path, 'r', encoding="utf8") as f:
+            data = f.read().replace(MEDIA_BASE_PLACEHOLDER, self.media_base)
+        return to_attrib_dict(json.loads(data))
+
+    def _api_call(self):
+        with self.lock:
+            self.api_calls += 1
+        if self.api_latency > 0:
+            time.sleep(self.api_latency)
+
+    def release(self, count):
+        """
+        Make the next count accounts visible. Returns the newly visible admin accounts.
+        """
+        count = min(count, len(self.accounts) - self.released)
+        self.released += count
+        return self.accounts[self.released - count:self.released]
+
+    def all_released(self):
+        return self.released >= len(self.accounts)
+
+    def _page(self, page_index, max_id = None, limit = None):
+        visible = self.accounts[:self.released][::-1]
+        if max_id is not None:
+            visible = [x for x in visible if int(x.id) < int(max_id)]
+        page_size = limit or self.page_size
+        page = visible[page_index * page_size:(page_index + 1) * page_size]
+        if len(page) == 0:
+            return None
+        return FakePage(page, page_index)
+
+    def admin_accounts_v2(self, origin = None, status = None, max_id = None, limit = None, **kwargs):
+        self._api_call()
+        page = self._page(0, max_id, limit)
+        if page is None:
+            return FakePage([], 0)
+        return page
+
+    def fetch_next(self, previous_page):
+        self._api_call()
+        return self._page(previous_page.page_index + 1)
+
+    def admin_account(self, id):
+        self._api_call()
+        if not id in self.accounts_by_id:
+            raise MastodonNotFoundError("Mastodon API returned error", 404, "Not Found", "Record not found")
+        return self.accounts_by_id[id]
+
+    def account_statuses(self, id, limit = None, **kwargs):
+        self._api_call()
+        statuses = self.statuses.get(str(id), [])
+        if limit is not None:
+            statuses = statuses[:limit]
+        return statuses
+
+    def report(self, account_id, status_ids = None, comment = None, forward = False, **kwargs):
+        self._api_call()
+        with self.lock:
+            report = AttribAccessDict({"id": len(self.reports) + 1, "target_account": account_id, "comment": comment})
+            self.reports.append(report)
+        return report
+
+    def admin_account_moderate(self, id, action = None, report_id = None, **kwargs):
+        self._api_call()
+        with self.lock:
+            self.moderation_actions.append((id, action))
+
+    def admin_report_reopen(self, id):
+        self._api_call()
+
+    def admin_create_domain_block(self, domain, severity = None, **kwargs):
+        self._api_call()
+        with self.lock:
+            self.domain_blocks.append((domain, severity))
+
+class _QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+class MediaServer:
+    """
+    Local http server for the fixture media directory
+    """
+    def __init__(self, fixture, host = "127.0.0.1", port = 0):
+        handler = functools.partial(_QuietHandler, directory = str(Path(fixture) / "media"))
+        self.server = ThreadingHTTPServer((host, port), handler)
+        self.thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+def send_account_events(app_url, webhook_secret, account_ids, event = "account.created", interval = 0.0):
+    """
+    Local event source: post signed account webhooks to a running app, the way mastodon would
+    """
+    sent = 0
+    for account_id in account_ids:
+        body = json.dumps({"event": event, "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()), "object": {"id": str(account_id)}}).encode("utf8")
+        signature = hmac.new(webhook_secret.encode("utf8"), body, hashlib.sha256).hexdigest()
+        response = requests.post(app_url.rstrip("/") + "/invoke_goku_account", data = body, headers = {"Content-Type": "application/json", "X-Hub-Signature": f"sha256={signature}"})
+        if response.status_code == 200:
+            sent += 1
+        if interval > 0:
+            time.sleep(interval)
+    return sent
+
+def _store_media(url, media_dir, timeout = 10):
+    """
+    Download one media url into the fixture, return placeholder url (or None on failure)
+    """
+    try:
+        response = requests.get(url, timeout = timeout)
+        response.raise_for_status()
+    except Exception:
+        return None
+    extension = url.split("?")[0].split(".")[-1].lower()
+    if len(extension) > 4 or not extension.isalnum():
+        extension = "bin"
+    name = hashlib.sha256(response.content).hexdigest()[:16] + "." + extension
+    with open(media_dir / name, 'wb') as f:
+        f.write(response.content)
+    return MEDIA_BASE_PLACEHOLDER + name
+
+def _write_fixture(fixture, pages, statuses, nodeinfo):
+    fixture = Path(fixture)
+    accounts = [account for page in pages for account in page]
+    with open(fixture / "accounts.json", 'w', encoding="utf8") as f:
+        json.dump(accounts, f, default=str)
+    with open(fixture / "statuses.json", 'w', encoding="utf8") as f:
+        json.dump(statuses, f, default=str)
+    with open(fixture / "nodeinfo.json", 'w', encoding="utf8") as f:
+        json.dump(nodeinfo, f, default=str)
+
+def record_fixture(mastodon, fixture, max_pages = 10, statuses_limit = 5, download_media = True):
+    """
+    Record admin account pages, statuses and media from a live instance.
+    Accounts are stored oldest first, which is the order the replay releases them in.
+    """
+    from mastodon import Mastodon
+    fixture = Path(fixture)
+    media_dir = fixture / "media"
+    os.makedirs(media_dir, exist_ok=True)
+
+    pages = []
+    page = mastodon.admin_accounts_v2(origin="remote", status="active")
+    while page is not None and len(page) > 0 and len(pages) < max_pages:
+        pages.append([json.loads(json.dumps(account, default=str)) for account in page])
+        page = mastodon.fetch_next(page)
+    pages = [page[::-1] for page in pages[::-1]]
+
+    statuses = {}
+    nodeinfo = {}
+    for page in pages:
+        for admin_account in page:
+            account = admin_account["account"]
+            account_statuses = [json.loads(json.dumps(status, default=str)) for status in mastodon.account_statuses(account["id"], limit=statuses_limit)]
+            if download_media:
+                for key in ["avatar", "header"]:
+                    if account.get(key):
+                        account[key] = _store_media(account[key], media_dir) or account[key]
+                for status in account_statuses:
+                    for attachment in status.get("media_attachments", []):
+                        if attachment.get("url"):
+                            attachment["url"] = _store_media(attachment["url"], media_dir) or attachment["url"]
+            statuses[str(account["id"])] = account_statuses
+
+            domain = account["acct"].split("@")[-1]
+            if not domain in nodeinfo:
+                try:
+                    nodeinfo[domain] = Mastodon(api_base_url = f"https://{domain}", version_check_mode="none", request_timeout=10).instance_nodeinfo()
+                except Exception:
+                    nodeinfo[domain] = None
+
+    _write_fixture(fixture, pages, statuses, nodeinfo)
+    return sum(len(page) for page in pages)
+
+def synthesize_fixture(fixture, raw_db_dir, num_accounts = 1000, spam_fraction = 0.05, num_domains = 50, seed = 0):
+    """
+    Generate a synthetic fixture. A spam_fraction of accounts reuse db_raw patterns so they produce hits,
+    the rest get random names, texts and noise images from a small pool.
+    """
+    from PIL import Image
+    rng = random.Random(seed)
+    fixture = Path(fixture)
+    raw_db_dir = Path(raw_db_dir)
+    media_dir = fixture / "media"
+    os.makedirs(media_dir, exist_ok=True)
+
+    # Benign media pool
+    benign_media = []
+    for idx in range(64):
+        image = Image.frombytes("RGB", (64, 64), bytes(rng.getrandbits(8) for _ in range(64 * 64 * 3)))
+        name = f"benign_{idx}.png"
+        image.save(media_dir / name)
+        benign_media.append(MEDIA_BASE_PLACEHOLDER + name)
+
+    # Spam media and texts straight from the db
+    def copy_patterns(field):
+        names = []
+        field_dir = raw_db_dir / field
+        if field_dir.is_dir():
+            for path in sorted(field_dir.iterdir()):
+                shutil.copyfile(path, media_dir / path.name)
+                names.append(MEDIA_BASE_PLACEHOLDER + path.name)
+        return names
+
+    def load_texts(field):
+        path = raw_db_dir / (field + ".json")
+        if path.exists():
+            return json.load(open(path, 'rb'))
+        return []
+
+    spam_avatars = copy_patterns("account.avatar") or benign_media
+    spam_media = copy_patterns("status.@.media_attachments.@.url") or benign_media
+    spam_notes = load_texts("account.note") or ["spam"]
+    spam_names = load_texts("account.display_name") or ["spam"]
+    spam_contents = load_texts("status.@.content") or ["spam"]
+
+    words = ["garden", "coffee", "train", "photo", "music", "cat", "rust", "python", "hiking", "bread", "moon", "synth", "knitting", "birds"]
+    def sentence(length):
+        return " ".join(rng.choice(words) for _ in range(length))
+
+    domains = [f"instance{idx}.example" for idx in range(num_domains)]
+    accounts = []
+    statuses = {}
+    for idx in range(num_accounts):
+        account_id = 100000 + idx
+        is_spam = rng.random() < spam_fraction
+        username = f"user{account_id}"
+        domain = rng.choice(domains)
+        account = {
+            "id": account_id,
+            "username": username,
+            "acct": f"{username}@{domain}",
+            "display_name": rng.choice(spam_names) if is_spam else sentence(2),
+            "note": rng.choice(spam_notes) if is_spam else sentence(rng.randint(3, 15)),
+            "avatar": rng.choice(spam_avatars) if is_spam else rng.choice(benign_media),
+            "header": rng.choice(benign_media),
+        }
+        accounts.append({"id": account_id, "username": username, "domain": domain, "account": account})
+
+        account_statuses = []
+        for status_idx in range(rng.randint(0, 5)):
+            media = []
+            if rng.random() < 0.3:
+                media.append({"type": "image", "url": rng.choice(spam_media) if is_spam else rng.choice(benign_media)})
+            account_statuses.append({
+                "id": account_id * 10 + status_idx,
+                "content": "<p>" + (rng.choice(spam_contents) if is_spam else sentence(rng.randint(3, 30))) + "</p>",
+                "media_attachments": media,
+                "account": account,
+            })
+        statuses[str(account_id)] = account_statuses
+
+    nodeinfo = {domain: {"openRegistrations": rng.random() < 0.5, "usage": {"users": {"total": rng.randint(1, 50000)}}} for domain in domains}
+    _write_fixture(fixture, [accounts], statuses, nodeinfo)
+    return num_accounts
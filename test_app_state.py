@@ -0,0 +1,141 @@
+# Tests for the shared state backends, run from the repository root:
+#   python -m unittest test_app_state
+
+import os
+import json
+import time
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from app_state import MemoryStateBackend, SqliteStateBackend
+from app_utils import ComponentManager, Logging, SettingsManager, Metrics
+
+# The goku round trip needs the model libraries to import (the models themselves are not loaded)
+try:
+    import automod.automod
+    have_goku = True
+except ImportError:
+    have_goku = False
+
+class StateBackendTests:
+    """
+    Claim and lease semantics every backend has to provide, mixed into a TestCase per backend
+    """
+    def create_backend(self):
+        raise NotImplementedError()
+
+    def test_claim_once(self):
+        state = self.create_backend()
+        self.assertTrue(state.claim("reported", 123))
+        self.assertFalse(state.claim("reported", "123"))
+        self.assertTrue(state.claim("other", 123))
+        self.assertEqual(state.set_members("reported"), {"123"})
+
+    def test_lease_refused_until_expired(self):
+        state = self.create_backend()
+        self.assertTrue(state.acquire_lease("leader", "a", 0.5))
+        self.assertFalse(state.acquire_lease("leader", "b", 0.5))
+        self.assertTrue(state.acquire_lease("leader", "a", 0.5))
+        time.sleep(0.6)
+        self.assertTrue(state.acquire_lease("leader", "b", 0.5))
+        self.assertFalse(state.acquire_lease("leader", "a", 0.5))
+
+    def test_lease_release(self):
+        state = self.create_backend()
+        self.assertTrue(state.acquire_lease("leader", "a", 60))
+        state.release_lease("leader", "b")
+        self.assertFalse(state.acquire_lease("leader", "b", 60))
+        state.release_lease("leader", "a")
+        self.assertTrue(state.acquire_lease("leader", "b", 60))
+
+class MemoryStateBackendTest(StateBackendTests, unittest.TestCase):
+    def create_backend(self):
+        return MemoryStateBackend()
+
+class SqliteStateBackendTest(StateBackendTests, unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tempdir.name, "state.db")
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def create_backend(self):
+        return SqliteStateBackend(self.path)
+
+    def test_claim_across_connections(self):
+        # Two replicas on the same file: exactly one gets each id
+        state_a = self.create_backend()
+        state_b = self.create_backend()
+        self.assertEqual([state_a.claim("reported", 123), state_b.claim("reported", 123)], [True, False])
+        self.assertTrue(state_b.set_contains("reported", 123))
+
+    def test_claim_race(self):
+        state = self.create_backend()
+        claimed = []
+        lock = threading.Lock()
+        def claim_all():
+            # One connection per thread
+            won = [x for x in range(200) if state.claim("reported", x)]
+            with lock:
+                claimed.extend(won)
+        threads = [threading.Thread(target=claim_all) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(claimed), list(range(200)))
+
+    def test_lease_across_connections(self):
+        state_a = self.create_backend()
+        state_b = self.create_backend()
+        self.assertTrue(state_a.acquire_lease("leader", "a", 0.5))
+        self.assertFalse(state_b.acquire_lease("leader", "b", 0.5))
+        time.sleep(0.6)
+        self.assertTrue(state_b.acquire_lease("leader", "b", 0.5))
+
+@unittest.skipUnless(have_goku, "goku dependencies not installed")
+class GokuReportedIdsTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.config_file = os.path.join(self.tempdir.name, "global_config.json")
+        with open(self.config_file, 'w') as f:
+            json.dump({
+                "base": {},
+                "goku": {
+                    "raw_db_dir": os.path.join(self.tempdir.name, "db_raw"),
+                    "embed_db_file": os.path.join(self.tempdir.name, "db.pkl"),
+                    "image_extensions": ["png"]
+                }
+            }, f)
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def create_goku(self, state):
+        component_manager = ComponentManager()
+        component_manager.register_component("settings", SettingsManager(self.config_file, component_manager))
+        component_manager.register_component("state", state)
+        component_manager.register_component("logging", Logging())
+        component_manager.register_component("metrics", Metrics())
+        with mock.patch("automod.automod.load_models", return_value = {}):
+            return automod.automod.Goku(component_manager)
+
+    def test_reported_ids_survive_restart(self):
+        # The memory backend starts empty, so the ids have to come back from the db pickle
+        state = MemoryStateBackend()
+        goku = self.create_goku(state)
+        state.claim("goku_reported_ids", 123)
+        state.claim("goku_reported_ids_nosuspend", 456)
+        goku.store_db()
+
+        state = MemoryStateBackend()
+        self.create_goku(state)
+        self.assertTrue(state.set_contains("goku_reported_ids", 123))
+        self.assertTrue(state.set_contains("goku_reported_ids_nosuspend", 456))
+        self.assertFalse(state.set_contains("goku_reported_ids", 456))
+
+if __name__ == "__main__":
+    unittest.main()